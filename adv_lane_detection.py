@@ -1,23 +1,115 @@
 import os
+import sys
+import functools
+import tempfile
+import time
 import click
 import cv2
+import numpy as np
 from utils import *
+from utils.binary_image import PREFILTERS
+from utils.camera_cal import find_chessboard_corners
+from utils.cli_options import (jobs_options, keyframe_options, calibration_options,
+                               processing_options)
+from utils.parallel import image_filenames, run_jobs
+from utils.stream_processor import CaptureSource, RawSource, StreamProcessor, open_result_sink
 
 general_cli = click.Group()
+camera_cache = {}
+
+
+def given_options(*names):
+    ''' returns the names of the options of the running command given on the command line '''
+    context = click.get_current_context()
+    return ['--' + name.replace('_', '-') for name in names
+            if context.get_parameter_source(name) != click.core.ParameterSource.DEFAULT]
+
+
+def check_fused_warp(fused_warp, roi, warp_maps=False):
+    ''' rejects the options --fused-warp leaves without effect, it thresholds the whole raw
+        frame and warps with its own composite remap '''
+    unused = [name for name, given in (('--roi', roi), ('--warp-maps', warp_maps)) if given]
+    if fused_warp and unused:
+        raise click.UsageError('{} {} no effect with --fused-warp'.format(
+            ' and '.join(unused), 'has' if len(unused) == 1 else 'have'))
+
+
+def make_scheduler(keyframe_interval, keyframe_subsample, keyframe_shift, keyframe_curve):
+    ''' returns the keyframe scheduler of the keyframe options, None detects every frame '''
+    if keyframe_interval <= 1:
+        return None
+    return KeyframeScheduler(1, keyframe_interval, keyframe_shift, keyframe_curve,
+                             keyframe_subsample)
+
+
+def lane_differences(reference, records, ploty=719):
+    ''' returns the absolute difference of left and right lane x at row ploty of a 720 pixel
+        high bird-eyes image and of the distance from center, all in pixels, per frame '''
+    return np.column_stack((
+        np.abs(np.polyval(reference[:, 0:3].T, ploty) - np.polyval(records[:, 0:3].T, ploty)),
+        np.abs(np.polyval(reference[:, 3:6].T, ploty) - np.polyval(records[:, 3:6].T, ploty)),
+        np.abs(reference[:, 6] - records[:, 6])))
+
+
+def load_camera(camera_input):
+    ''' loads camera parameters once per process '''
+    cam_cal = camera_cache.get(camera_input)
+    if cam_cal is None:
+        cam_cal = CameraCalibration()
+        cam_cal.load(camera_input)
+        camera_cache[camera_input] = cam_cal
+    return cam_cal
+
+
+def process_files(function, filenames, jobs, max_in_flight):
+    ''' runs function on every filename, reports failed files and returns results in order '''
+    results = []
+    failures = 0
+    for filename, result, error in run_jobs(function, filenames, jobs, max_in_flight):
+        if error is not None:
+            failures += 1
+            click.echo('{}: failed, {}'.format(filename, error), err=True)
+        results.append(result)
+    if failures:
+        raise click.ClickException('{} of {} files failed'.format(failures, len(filenames)))
+    return results
+
+
+def read_image(filename):
+    image = cv2.imread(filename)
+    if image is None:
+        raise Exception("Can't read image {}.".format(filename))
+    return image
+
+def chessboard_file(filename, scale):
+    ''' returns the chessboard corners of an image file, None without a board, and its size,
+        so a worker sends back only the corners and not the decoded image '''
+    image = read_image(filename)
+    return find_chessboard_corners(image, scale), (image.shape[1], image.shape[0])
 
 @general_cli.command()
 @click.option('--input-dir', default='data', help='Input directory of camera calibration images.',
               prompt='Input directory')
 @click.option('--output', default='camera.p', help='Camera parameters output filename.')
-def calibrate(input_dir, output):
-    filenames = os.listdir(input_dir)
-    images = []
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            img = cv2.imread(os.path.join(input_dir, filename))
-            images.append(img)
+@click.option('--scale', default=0.5,
+              help='Downscale of the coarse chessboard search, corners are refined at full size.')
+@jobs_options
+def calibrate(input_dir, output, scale, jobs, max_in_flight):
+    filenames = [os.path.join(input_dir, filename) for filename in image_filenames(input_dir)]
+    start = time.time()
+    found = process_files(functools.partial(chessboard_file, scale=scale), filenames, jobs,
+                          max_in_flight)
     cam_cal = CameraCalibration()
-    cam_cal.compute(images)
+    # the image size of the last image, like compute
+    cam_cal.compute_from_corners([corners for corners, _ in found], found[-1][1], filenames)
+    for filename, error in cam_cal.report:
+        if error is None:
+            click.echo('{}: no chessboard found, not used'.format(filename))
+        else:
+            click.echo('{}: reprojection error {:.3f} px'.format(filename, error))
+    click.echo('Calibrated from {} of {} images in {:.2f} s'.format(
+        sum(error is not None for _, error in cam_cal.report), len(filenames),
+        time.time() - start))
     cam_cal.save(output)
 
 
@@ -28,17 +120,19 @@ def calibrate(input_dir, output):
               prompt='Input directory')
 @click.option('--output-dir', help='Output directory of undistorted images.',
               prompt='Output directory')
-def undistort(camera_input, input_dir, output_dir):
+@jobs_options
+def undistort(camera_input, input_dir, output_dir, jobs, max_in_flight):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    cam_cal = CameraCalibration()
-    cam_cal.load(camera_input)
-    filenames = os.listdir(input_dir)
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            image = cv2.imread(os.path.join(input_dir, filename))
-            cv2.imwrite(os.path.join(output_dir, os.path.splitext(filename)[0] + '.png'),
-                        cam_cal.undistort(image))
+    load_camera(camera_input)
+    process_files(functools.partial(undistort_file, camera_input=camera_input,
+                                    input_dir=input_dir, output_dir=output_dir),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def undistort_file(filename, camera_input, input_dir, output_dir):
+    image = read_image(os.path.join(input_dir, filename))
+    cv2.imwrite(os.path.join(output_dir, os.path.splitext(filename)[0] + '.png'),
+                load_camera(camera_input).undistort(image))
 
 @general_cli.command('test-undistort')
 @click.option('--camera-input', default='camera.p', help='Input camera parameters filename.',
@@ -58,32 +152,90 @@ def test_undistort(camera_input, input_file, output_file):
               prompt='Input directory')
 @click.option('--output-dir', help='Output directory of binary images.',
               prompt='Output directory')
-def binary_image(input_dir, output_dir):
+@processing_options('roi', 'threshold_engine', 'prefilter')
+@jobs_options
+def binary_image(input_dir, output_dir, roi, threshold_engine, prefilter, jobs, max_in_flight):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    filenames = os.listdir(input_dir)
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            image = cv2.imread(os.path.join(input_dir, filename))
+    process_files(functools.partial(binary_image_file, input_dir=input_dir,
+                                    output_dir=output_dir, roi=roi,
+                                    threshold_engine=threshold_engine, prefilter=prefilter),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def binary_image_file(filename, input_dir, output_dir, roi, threshold_engine, prefilter):
+    image = read_image(os.path.join(input_dir, filename))
+    bin_img = BinaryImage(image, kernel=5, grad_thresh=(20, 100),
+                          sat_thresh=(120, 255), light_thresh=(45, 255),
+                          mag_thresh=(30, 100), dir_thresh=(0.7, 1.3),
+                          roi=PerspectiveTransform(image) if roi else None,
+                          engine=threshold_engine, prefilter=prefilter)
+    cv2.imwrite(os.path.join(output_dir, filename), bin_img.get())
+
+@general_cli.command('test-binary-engine')
+@click.option('--input-dir', default='test_images', help='Input directory of test images.')
+def test_binary_engine(input_dir):
+    mismatches = 0
+    for filename in image_filenames(input_dir):
+        image = cv2.imread(os.path.join(input_dir, filename))
+        binaries = []
+        for engine in ('reference', 'fast'):
             bin_img = BinaryImage(image, kernel=5, grad_thresh=(20, 100),
                                   sat_thresh=(120, 255), light_thresh=(45, 255),
-                                  mag_thresh=(30, 100), dir_thresh=(0.7, 1.3))
-            cv2.imwrite(os.path.join(output_dir, filename), bin_img.get())
+                                  mag_thresh=(30, 100), dir_thresh=(0.7, 1.3), engine=engine)
+            binaries.append(bin_img.get())
+        different = int((binaries[0] != binaries[1]).sum())
+        mismatches += different
+        click.echo('{}: {} different pixels ({:.4%})'.format(filename, different,
+                                                             different / binaries[0].size))
+    if mismatches:
+        raise click.ClickException('fast threshold engine differs from reference')
+
+@general_cli.command('test-batch-processing')
+@click.option('--input-dir', default='test_images', help='Input directory of test images.')
+@calibration_options
+@processing_options('fused_warp', 'roi', 'prefilter')
+def test_batch_processing(input_dir, camera_input, camera_cal_dir, calibration_cache,
+                          fused_warp, roi, prefilter):
+    check_fused_warp(fused_warp, roi)
+    filenames = image_filenames(input_dir)
+    frames = np.stack([cv2.imread(os.path.join(input_dir, filename)) for filename in filenames])
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    outputs = []
+    for batched in (False, True):
+        processor = VideoProcessor(None, None, LaneTracker(cam_cal), fused_warp=fused_warp,
+                                   roi=roi, threshold_engine='fast', prefilter=prefilter)
+        start = time.time()
+        if batched:
+            outputs.append(processor.process_batch(frames))
+        else:
+            outputs.append(np.stack([processor.process_bgr(frame) for frame in frames]))
+        click.echo('{}: {:.1f} ms/frame'.format('batch' if batched else 'per frame',
+                                                (time.time() - start) * 1000 / len(frames)))
+    mismatches = 0
+    for filename, single, batch in zip(filenames, outputs[0], outputs[1]):
+        different = int(np.any(single != batch, axis=2).sum())
+        mismatches += different
+        click.echo('{}: {} different pixels'.format(filename, different))
+    if mismatches:
+        raise click.ClickException('batch processing differs from per frame processing')
 
 @general_cli.command('perspective-transform')
 @click.option('--input-dir', help='Input directory contains images to apply perspective transform.',
               prompt='Input directory')
 @click.option('--output-dir', help='Output directory of binary images.',
               prompt='Output directory')
-def perspective_transform(input_dir, output_dir):
+@jobs_options
+def perspective_transform(input_dir, output_dir, jobs, max_in_flight):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    filenames = os.listdir(input_dir)
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            image = cv2.imread(os.path.join(input_dir, filename))
-            pers_img = PerspectiveTransform(image)
-            cv2.imwrite(os.path.join(output_dir, filename), pers_img.get())
+    process_files(functools.partial(perspective_transform_file, input_dir=input_dir,
+                                    output_dir=output_dir),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def perspective_transform_file(filename, input_dir, output_dir):
+    image = read_image(os.path.join(input_dir, filename))
+    pers_img = PerspectiveTransform(image)
+    cv2.imwrite(os.path.join(output_dir, filename), pers_img.get())
 
 @general_cli.command('test-perspective-transform')
 @click.option('--input-file', help='Input image file.',
@@ -95,22 +247,56 @@ def test_perspective_transform(input_file, output_file):
     pers_img = PerspectiveTransform(image)
     cv2.imwrite(output_file, pers_img.visualize())
 
+@general_cli.command('benchmark-prefilter')
+@click.option('--input-dir', default='test_images', help='Input directory of test images.')
+@click.option('--repeat', default=3, help='Number of timed runs per image and pre-filter.')
+def benchmark_prefilter(input_dir, repeat):
+    images = [cv2.imread(os.path.join(input_dir, filename))
+              for filename in image_filenames(input_dir)]
+    results = {}
+    for prefilter in ['bilateral'] + sorted(set(PREFILTERS) - {'bilateral'}):
+        elapsed = 0
+        fits = []
+        for image in images:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                bin_img = BinaryImage(image, kernel=5, grad_thresh=(20, 100),
+                                      sat_thresh=(120, 255), light_thresh=(45, 255),
+                                      mag_thresh=(30, 100), dir_thresh=(0.7, 1.3),
+                                      prefilter=prefilter)
+                binary = bin_img.get()
+                elapsed += time.perf_counter() - start
+            finder = LaneFinder(PerspectiveTransform(binary).get())
+            finder.slide_window()
+            ploty = np.arange(binary.shape[0])
+            fits.append([np.polyval(finder.left_fit, ploty), np.polyval(finder.right_fit, ploty)])
+        results[prefilter] = (1000 * elapsed / (repeat * len(images)), np.array(fits))
+    baseline = results['bilateral'][1]
+    click.echo('{:<22}{:>12}{:>26}'.format('pre-filter', 'ms/frame', 'lane fit error (px, mean)'))
+    for prefilter, (ms_per_frame, fits) in results.items():
+        click.echo('{:<22}{:>12.1f}{:>26.2f}'.format(prefilter, ms_per_frame,
+                                                    np.mean(np.abs(fits - baseline))))
+
 @general_cli.command('lane-finder')
 @click.option('--input-dir', help='Input directory contains perspective gray images for finding lanes.',
               prompt='Input directory')
 @click.option('--output-dir', help='Output directory for images.',
               prompt='Output directory')
-def lane_finder(input_dir, output_dir):
+@jobs_options
+def lane_finder(input_dir, output_dir, jobs, max_in_flight):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    filenames = os.listdir(input_dir)
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            image = cv2.imread(os.path.join(input_dir, filename))
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            finder = LaneFinder(image)
-            finder.slide_window()
-            cv2.imwrite(os.path.join(output_dir, filename), finder.visualize())
+    process_files(functools.partial(lane_finder_file, input_dir=input_dir,
+                                    output_dir=output_dir),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def lane_finder_file(filename, input_dir, output_dir):
+    image = read_image(os.path.join(input_dir, filename))
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # a fresh single frame tracker per image, as cache=False implies
+    finder = LaneFinder(image)
+    finder.slide_window()
+    cv2.imwrite(os.path.join(output_dir, filename), finder.visualize())
 
 
 @general_cli.command('lane-visualizer')
@@ -120,34 +306,348 @@ def lane_finder(input_dir, output_dir):
               prompt='Original directory')
 @click.option('--output-dir', help='Output directory for images.',
               prompt='Output directory')
-def lane_visualizer(input_dir, original_dir, output_dir):
+@jobs_options
+def lane_visualizer(input_dir, original_dir, output_dir, jobs, max_in_flight):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    filenames = os.listdir(input_dir)
-    for filename in filenames:
-        if filename.endswith('.jpg') or filename.endswith('.png'):
-            image = cv2.imread(os.path.join(input_dir, filename))
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            finder = LaneFinder(image)
-            finder.slide_window()
-            overlay = finder.visualize(draw_lane_pixels=False, draw_on_image=False)
-            undist = cv2.imread(os.path.join(original_dir, filename))
-            pers_img = PerspectiveTransform(overlay)
-            inverse_pers_img = pers_img.get_inverse()
-            undist_overlay = cv2.addWeighted(undist, 1, inverse_pers_img, 0.3, 0)
-            undist_overlay = finder.draw_info(undist_overlay)
-            cv2.imwrite(os.path.join(output_dir, filename), undist_overlay)
+    process_files(functools.partial(lane_visualizer_file, input_dir=input_dir,
+                                    original_dir=original_dir, output_dir=output_dir),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def lane_visualizer_file(filename, input_dir, original_dir, output_dir):
+    image = read_image(os.path.join(input_dir, filename))
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    finder = LaneFinder(image)
+    finder.slide_window()
+    overlay = finder.visualize(draw_lane_pixels=False, draw_on_image=False)
+    undist = read_image(os.path.join(original_dir, filename))
+    pers_img = PerspectiveTransform(overlay)
+    inverse_pers_img = pers_img.get_inverse()
+    undist_overlay = cv2.addWeighted(undist, 1, inverse_pers_img, 0.3, 0)
+    undist_overlay = finder.draw_info(undist_overlay)
+    cv2.imwrite(os.path.join(output_dir, filename), undist_overlay)
+
+PIPELINE_STAGES = ('undist', 'binary', 'perspective', 'lanes')
+
+@general_cli.command('pipeline')
+@click.option('--camera-input', default='camera.p', help='Input camera parameters filename.',
+              prompt='Input camera filename')
+@click.option('--input-dir', help='Input directory contains road images.',
+              prompt='Input directory')
+@click.option('--output-dir', default='output_images',
+              help='Output directory, final images go to its final sub-directory.')
+@click.option('--save-stage', multiple=True, type=click.Choice(PIPELINE_STAGES),
+              help='Also write this intermediate stage to its sub-directory, may be repeated.')
+@processing_options('roi', 'threshold_engine', 'prefilter')
+@click.option('--overlay', default='warp', type=click.Choice(VideoProcessor.OVERLAYS),
+              help='Lane overlay drawing, project blends the projected lane outline only.')
+@jobs_options
+def pipeline(camera_input, input_dir, output_dir, save_stage, roi, threshold_engine, prefilter,
+             overlay, jobs, max_in_flight):
+    for stage in tuple(save_stage) + ('final',):
+        os.makedirs(os.path.join(output_dir, stage), exist_ok=True)
+    load_camera(camera_input)
+    process_files(functools.partial(pipeline_file, camera_input=camera_input,
+                                    input_dir=input_dir, output_dir=output_dir,
+                                    save_stage=tuple(save_stage), roi=roi,
+                                    threshold_engine=threshold_engine, prefilter=prefilter,
+                                    overlay=overlay),
+                  image_filenames(input_dir), jobs, max_in_flight)
+
+def draw_overlay(finder, undist, overlay, draw_windows=True):
+    ''' returns undist with the lane of finder blended in, without the text, the warped
+        overlay also shows the search windows when draw_windows is set '''
+    if overlay == 'project':
+        points = PerspectiveTransform(undist).get_inverse_points(finder.lane_polygon())
+        return blend_polygon(undist.copy(), points)
+    inverse_pers_img = PerspectiveTransform(
+        finder.visualize(draw_lane_pixels=False, draw_on_image=False,
+                         draw_windows=draw_windows)).get_inverse()
+    return cv2.addWeighted(undist, 1, inverse_pers_img, 0.3, 0)
+
+def pipeline_file(filename, camera_input, input_dir, output_dir, save_stage, roi,
+                  threshold_engine, prefilter, overlay):
+    image = read_image(os.path.join(input_dir, filename))
+    stages = {}
+    stages['undist'] = undist = load_camera(camera_input).undistort(image)
+    bin_img = BinaryImage(undist, kernel=5, grad_thresh=(20, 100),
+                          sat_thresh=(120, 255), light_thresh=(45, 255),
+                          mag_thresh=(30, 100), dir_thresh=(0.7, 1.3),
+                          roi=PerspectiveTransform(undist) if roi else None,
+                          engine=threshold_engine, prefilter=prefilter)
+    stages['binary'] = binary = bin_img.get()
+    stages['perspective'] = perspective = PerspectiveTransform(binary).get()
+    finder = LaneFinder(perspective)
+    finder.slide_window()
+    if 'lanes' in save_stage:
+        stages['lanes'] = finder.visualize()
+    stages['final'] = finder.draw_info(draw_overlay(finder, undist, overlay))
+    output_filename = os.path.splitext(filename)[0] + '.png'
+    for stage in save_stage + ('final',):
+        cv2.imwrite(os.path.join(output_dir, stage, output_filename), stages[stage])
 
 @general_cli.command('process-video')
 @click.option('--input-file', help='Input video file.',
               prompt='Input video')
 @click.option('--output-file', help='Output video file.',
               prompt='Output video')
+@calibration_options
+@processing_options('fused_warp', 'roi', 'threshold_engine', 'prefilter', 'track', 'work_scale')
+@click.option('--jobs', default=1, help='Number of processes, each handles one time segment.')
+@click.option('--warmup', default=10,
+              help='Frames each segment pre-rolls to warm up the lane history with --jobs.')
+@click.option('--read-queue', default=8, help='Decoded frames buffered ahead of processing.')
+@click.option('--write-queue', default=8, help='Processed frames buffered ahead of encoding.')
+@click.option('--codec', default='libx264',
+              help='ffmpeg codec of the output video, with or without --jobs.')
+@click.option('--batch-size', default=1,
+              help='Frames thresholded together as one stack, uses the fast engine votes.')
 @click.option('--debug', default=False)
-def process_video(input_file, output_file, debug):
-    debug_dir = 'debug_images' if debug else None
-    VideoProcessor.init(input_file, output_file, 'camera_cal', debug_dir)
-    VideoProcessor.process()
+@click.option('--debug-dir', default='debug_images', help='Output directory of debug frames.')
+@click.option('--debug-stage', multiple=True, type=click.Choice(DebugWriter.STAGES),
+              help='Stage written with --debug, may be repeated, all stages by default.')
+@click.option('--debug-format', default='png', type=click.Choice(DebugWriter.FORMATS),
+              help='Debug image format, npz stores all stages of a frame in one archive.')
+@click.option('--debug-every', default=10, help='Write debug images of every n-th frame.')
+@click.option('--debug-queue', default=8,
+              help='Debug frames waiting to be written, more are dropped.')
+@click.option('--profile', default=None,
+              help='Time every stage, write per frame records to this .csv or .json file and '
+                   'print p50/p95/p99 per stage.')
+@click.option('--overlay', default='warp', type=click.Choice(VideoProcessor.OVERLAYS),
+              help='Lane overlay drawing, project blends the projected lane outline only.')
+@click.option('--metrics-only', is_flag=True,
+              help='Write per frame lane records to --output-file (.csv, .npz or .parquet) '
+                   'instead of an annotated video.')
+@click.option('--metrics-chunk', default=1000, help='Frames per chunk written with --metrics-only.')
+@click.option('--warp-maps', is_flag=True,
+              help='Warp with cached remap tables, faster but not bit exact to warpPerspective.')
+@keyframe_options
+def process_video(input_file, output_file, camera_input, camera_cal_dir, calibration_cache,
+                  fused_warp, roi, threshold_engine, prefilter, track, jobs, warmup, read_queue,
+                  write_queue, codec, batch_size, debug, debug_dir, debug_stage, debug_format,
+                  debug_every, debug_queue, profile, overlay, metrics_only, metrics_chunk,
+                  warp_maps, work_scale, keyframe_interval, keyframe_subsample, keyframe_shift,
+                  keyframe_curve):
+    check_fused_warp(fused_warp, roi, warp_maps)
+    if warp_maps and work_scale > 1:
+        raise click.UsageError('--warp-maps has no effect with --work-scale, subsampled frames '
+                               'are warped with warpPerspective')
+    if metrics_only and (jobs > 1 or batch_size > 1 or debug):
+        raise click.UsageError('--metrics-only runs in one process without --jobs, --batch-size '
+                               'or --debug')
+    unused = []
+    if metrics_only:
+        unused = given_options('write_queue', 'codec', 'overlay')
+    elif jobs > 1:
+        unused = given_options('read_queue', 'write_queue', 'batch_size')
+    elif given_options('warmup'):
+        unused = ['--warmup']
+    if unused:
+        raise click.UsageError('{} {} no effect {}'.format(
+            ', '.join(unused), 'has' if len(unused) == 1 else 'have', 'with --metrics-only' if metrics_only else
+            'with --jobs' if jobs > 1 else 'without --jobs'))
+    scheduler = make_scheduler(keyframe_interval, keyframe_subsample, keyframe_shift,
+                               keyframe_curve)
+    if scheduler is not None and batch_size > 1:
+        raise click.UsageError('--keyframe-interval processes one frame at a time, '
+                               'it needs --batch-size 1')
+    if work_scale > 1 and batch_size > 1:
+        raise click.UsageError('--work-scale processes one frame at a time, it needs '
+                               '--batch-size 1')
+    debug_writer = None
+    if debug:
+        debug_writer = DebugWriter(debug_dir, debug_stage or DebugWriter.STAGES, debug_format,
+                                   debug_every, debug_queue)
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    tracker = LaneTracker(cam_cal, profile=profile is not None, scheduler=scheduler)
+    processor = VideoProcessor(input_file, output_file, tracker, debug_writer,
+                               fused_warp=fused_warp, roi=roi, threshold_engine=threshold_engine,
+                               prefilter=prefilter, track=track, overlay=overlay,
+                               work_scale=work_scale, warp_maps=warp_maps)
+    if metrics_only:
+        processor.process_metrics(output_file, metrics_chunk, read_queue)
+    elif jobs > 1:
+        processor.process_segmented(jobs, warmup, codec)
+    else:
+        processor.process(read_queue, write_queue, codec, batch_size)
+    if profile is not None:
+        tracker.timer.print_summary()
+        tracker.timer.save(profile)
+
+@general_cli.command('test-overlay')
+@click.option('--camera-input', default='camera.p', help='Input camera parameters filename.')
+@click.option('--input-dir', default='test_images', help='Input directory of road images.')
+@click.option('--repeat', default=20, help='Timed runs of each overlay per image.')
+def test_overlay(camera_input, input_dir, repeat):
+    cam_cal = load_camera(camera_input)
+    filenames = image_filenames(input_dir)
+    times = dict.fromkeys(VideoProcessor.OVERLAYS, 0.0)
+    for filename in filenames:
+        undist = cam_cal.undistort(read_image(os.path.join(input_dir, filename)))
+        binary = BinaryImage(undist, kernel=5, grad_thresh=(20, 100), sat_thresh=(120, 255),
+                             light_thresh=(45, 255), mag_thresh=(30, 100),
+                             dir_thresh=(0.7, 1.3)).get()
+        finder = LaneFinder(PerspectiveTransform(binary).get())
+        finder.slide_window()
+        outputs = {}
+        for overlay in VideoProcessor.OVERLAYS:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                outputs[overlay] = draw_overlay(finder, undist, overlay, draw_windows=False)
+            times[overlay] += time.perf_counter() - start
+        difference = np.abs(outputs['warp'].astype(np.int16) - outputs['project']).max(axis=2)
+        click.echo('{}: {} pixels differ, {} by more than 8, largest {}'.format(
+            filename, np.count_nonzero(difference), np.count_nonzero(difference > 8),
+            difference.max()))
+    click.echo(', '.join('{} {:.2f} ms'.format(overlay, seconds * 1000 / len(filenames) / repeat)
+                         for overlay, seconds in times.items()))
+
+@general_cli.command('stream')
+@click.option('--source', default=None,
+              help='cv2.VideoCapture source: camera index, video file or URL.')
+@click.option('--raw', default=None,
+              help='Raw BGR frames of --size from a named pipe, file or - for stdin.')
+@click.option('--size', default='1280x720', help='WIDTHxHEIGHT of --raw frames.')
+@click.option('--source-fps', default=0.0,
+              help='Pace reads at this frame rate, for sources that are not real time.')
+@click.option('--budget-ms', default=50.0,
+              help='Per frame latency budget, older frames are skipped.')
+@click.option('--output', default='-',
+              help='Where JSON lane results go: - for stdout, tcp://host:port or a file.')
+@calibration_options
+@processing_options('fused_warp', 'roi', 'threshold_engine', 'prefilter', 'track', 'work_scale')
+def stream(source, raw, size, source_fps, budget_ms, output, camera_input, camera_cal_dir,
+           calibration_cache, fused_warp, roi, threshold_engine, prefilter, track, work_scale):
+    if (source is None) == (raw is None):
+        raise click.UsageError('give exactly one of --source and --raw')
+    check_fused_warp(fused_warp, roi)
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    processor = VideoProcessor(None, None, LaneTracker(cam_cal), fused_warp=fused_warp, roi=roi,
+                               threshold_engine=threshold_engine, prefilter=prefilter,
+                               track=track, work_scale=work_scale)
+    if raw is not None:
+        frame_source = RawSource(raw, tuple(int(value) for value in size.split('x')))
+    else:
+        frame_source = CaptureSource(source)
+    sink = open_result_sink(output)
+    try:
+        stats = StreamProcessor(frame_source, processor, budget_ms, sink, source_fps).run()
+    finally:
+        frame_source.close()
+        if sink is not sys.stdout:
+            sink.close()
+    click.echo('{} frames read, {} processed at {:.1f} fps, {} dropped, {} stale, '
+               '{} over budget'.format(stats['frames_read'], stats['processed'], stats['fps'],
+                                       stats['dropped'], stats['stale'], stats['late']),
+               err=True)
+    if stats['processed']:
+        click.echo('end to end latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms']), err=True)
+
+@general_cli.command('test-segmented-video')
+@click.option('--input-file', help='Input video file.', prompt='Input video')
+@calibration_options
+@processing_options('track')
+@click.option('--jobs', default=4, help='Number of segments.')
+@click.option('--warmup', default=10, help='Frames each segment pre-rolls.')
+def test_segmented_video(input_file, camera_input, camera_cal_dir, calibration_cache, jobs, warmup,
+                         track):
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    processor = VideoProcessor(input_file, None, LaneTracker(cam_cal, record=True), track=track)
+    serial = np.array(processor.copy().process_segment(0, sys.maxsize).records)
+    segmented = np.concatenate([tracker.records
+                                for tracker in processor.process_segmented(jobs, warmup)])
+    if serial.shape != segmented.shape:
+        raise click.ClickException('serial run has {} frames, segmented run {}'.format(
+            len(serial), len(segmented)))
+    difference = lane_differences(serial, segmented).max(axis=1)
+    in_warmup = np.zeros(len(serial), bool)
+    for job in range(1, jobs):
+        start = len(serial) * job // jobs
+        in_warmup[start:start + warmup] = True
+    click.echo('max difference after warm-up: {:.6f} px'.format(
+        difference[~in_warmup].max(initial=0)))
+    click.echo('max difference within warm-up: {:.6f} px'.format(
+        difference[in_warmup].max(initial=0)))
+    # look-ahead tracking keeps a longer history, so it is only reported
+    if not track and difference[~in_warmup].max(initial=0) > 1e-6:
+        raise click.ClickException('segmented run differs from serial run after warm-up')
+
+@general_cli.command('test-keyframes')
+@click.option('--input-file', help='Input video file.', prompt='Input video')
+@calibration_options
+@processing_options('fused_warp', 'threshold_engine', 'prefilter', 'track')
+@keyframe_options
+def test_keyframes(input_file, camera_input, camera_cal_dir, calibration_cache, fused_warp,
+                   threshold_engine, prefilter, track, keyframe_interval, keyframe_subsample,
+                   keyframe_shift, keyframe_curve):
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    scheduler = make_scheduler(max(keyframe_interval, 2), keyframe_subsample, keyframe_shift,
+                               keyframe_curve)
+    runs = []
+    for run_scheduler in (None, scheduler):
+        tracker = LaneTracker(cam_cal, record=True, scheduler=run_scheduler)
+        processor = VideoProcessor(input_file, None, tracker, fused_warp=fused_warp,
+                                   threshold_engine=threshold_engine, prefilter=prefilter,
+                                   track=track)
+        start = time.perf_counter()
+        processor.process_segment(0, sys.maxsize)
+        runs.append((np.array(tracker.records), time.perf_counter() - start))
+    (every_frame, every_frame_time), (keyframes, keyframes_time) = runs
+    click.echo(scheduler.report())
+    click.echo('every frame {:.1f} s, keyframes {:.1f} s, {:.2f}x faster'.format(
+        every_frame_time, keyframes_time, every_frame_time / keyframes_time))
+    difference = lane_differences(every_frame, keyframes)
+    click.echo('{:<24}{:>10}{:>10}{:>10}'.format('error vs every frame', 'mean', 'p95', 'max'))
+    for name, values in (('left lane x (px)', difference[:, 0]),
+                         ('right lane x (px)', difference[:, 1]),
+                         ('center distance (m)', difference[:, 2] * 3.7 / 700)):
+        click.echo('{:<24}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            name, values.mean(), np.percentile(values, 95), values.max()))
+
+@general_cli.command('test-work-scale')
+@click.option('--input-file', help='Input video file.', prompt='Input video')
+@calibration_options
+@processing_options()
+@click.option('--work-scale', multiple=True, type=int, default=(2, 4),
+              help='Work scale compared against full resolution, may be repeated.')
+def test_work_scale(input_file, camera_input, camera_cal_dir, calibration_cache, fused_warp, roi,
+                    threshold_engine, prefilter, track, work_scale):
+    check_fused_warp(fused_warp, roi)
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    runs = []
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        for scale in (1,) + tuple(work_scale):
+            metrics_file = os.path.join(metrics_dir, '{}.npz'.format(scale))
+            processor = VideoProcessor(input_file, None, LaneTracker(cam_cal),
+                                       fused_warp=fused_warp, roi=roi,
+                                       threshold_engine=threshold_engine, prefilter=prefilter,
+                                       track=track, work_scale=scale)
+            start = time.perf_counter()
+            processor.process_metrics(metrics_file)
+            runs.append((scale, MetricsWriter.read(metrics_file), time.perf_counter() - start))
+    _, full, full_time = runs[0]
+    for scale, records, run_time in runs[1:]:
+        # each frame's own fits, so the line averaging does not hide the error
+        click.echo('work scale 1/{}: {:.1f} s against {:.1f} s, {:.2f}x faster'.format(
+            scale, run_time, full_time, full_time / run_time))
+        differences = []
+        for side in ('left', 'right'):
+            fits = [np.column_stack([run['{}_fit_{}'.format(side, name)] for name in 'abc'])
+                    for run in (full, records)]
+            differences.append(('{} lane x (px)'.format(side),
+                                np.abs(np.polyval(fits[0].T, 719) - np.polyval(fits[1].T, 719))))
+        for side in ('left', 'right'):
+            differences.append(('{} curvature (1/km)'.format(side),
+                                np.abs(1000 / full['{}_curverad'.format(side)] -
+                                       1000 / records['{}_curverad'.format(side)])))
+        differences.append(('center distance (m)', np.abs(full['distance_from_center'] -
+                                                          records['distance_from_center'])))
+        click.echo('{:<24}{:>10}{:>10}{:>10}'.format('error vs full', 'mean', 'p95', 'max'))
+        for name, values in differences:
+            click.echo('{:<24}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                name, values.mean(), np.percentile(values, 95), values.max()))
 
 if __name__ == '__main__':
     general_cli()
@@ -0,0 +1,247 @@
+''' Benchmarks each stage and the whole pipeline on test_images and a synthetic video
+
+    python -m benchmarks.run run --output bench.json --baseline baseline.json --threshold 0.1
+    python -m benchmarks.run compare bench.json baseline.json --threshold 0.1
+'''
+import os
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+import click
+import cv2
+import numpy as np
+from utils import BinaryImage, PerspectiveTransform, LaneFinder, LaneTracker, VideoProcessor
+from utils.cli_options import calibration_options
+from utils.keyframe_scheduler import KeyframeScheduler
+from utils.parallel import image_filenames
+from benchmarks.synthetic import write_synthetic_video
+
+
+def parse_resolutions(resolutions):
+    ''' parses "1280x720,640x360" into [(1280, 720), (640, 360)] '''
+    return [tuple(int(value) for value in resolution.split('x'))
+            for resolution in resolutions.split(',')]
+
+
+def load_images(input_dir, img_size):
+    ''' returns the test images resized to img_size '''
+    images = []
+    for filename in image_filenames(input_dir):
+        image = cv2.imread(os.path.join(input_dir, filename))
+        if (image.shape[1], image.shape[0]) != img_size:
+            image = cv2.resize(image, img_size, interpolation=cv2.INTER_AREA)
+        images.append(image)
+    return images
+
+
+def latency_result(latencies):
+    ''' returns fps from the mean and the p50, p95 and p99 of latencies in milliseconds '''
+    return {'fps': 1000 / latencies.mean(),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'samples': len(latencies)}
+
+
+def measure(function, inputs, repeat):
+    ''' calls function on every input repeat times after one warm-up pass, returns fps,
+        latency percentiles and the peak numpy/python memory of one traced pass '''
+    for item in inputs:
+        function(item)
+    latencies = []
+    for _ in range(repeat):
+        for item in inputs:
+            start = time.perf_counter()
+            function(item)
+            latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for item in inputs:
+        function(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = latency_result(np.array(latencies) * 1000)
+    result['peak_memory_mb'] = peak / 2 ** 20
+    return result
+
+
+def stage_benchmarks(cam_cal, images):
+    ''' returns stage name to (function, inputs), each input is the output of the stage before
+
+    Images on which slide_window finds no pixels of a lane have no fit to draw, they are left
+    out of every stage so all stages run on the same images.
+    '''
+    undist = [cam_cal.undistort(image) for image in images]
+    binary = [BinaryImage(image, kernel=5, grad_thresh=(20, 100), sat_thresh=(120, 255),
+                          light_thresh=(45, 255), mag_thresh=(30, 100),
+                          dir_thresh=(0.7, 1.3)).get() for image in undist]
+    perspective = [PerspectiveTransform(image).get() for image in binary]
+    finders = []
+    for index, image in enumerate(perspective):
+        finder = LaneFinder(image)
+        try:
+            finder.slide_window()
+        except IndexError:
+            finder = None
+        finders.append(finder)
+    found = [index for index, finder in enumerate(finders) if finder is not None]
+    images, undist, binary, perspective, finders = (
+        [values[index] for index in found]
+        for values in (images, undist, binary, perspective, finders))
+    overlays = [finder.visualize(draw_lane_pixels=False, draw_on_image=False)
+                for finder in finders]
+    rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
+
+    def slide_window(image):
+        LaneFinder(image).slide_window()
+
+    def process_image(image):
+        # a fresh tracker per call keeps every image independent like the stage benchmarks
+        VideoProcessor(None, None, LaneTracker(cam_cal)).process_image(image)
+
+    return {
+        'undistort': (cam_cal.undistort, images),
+        'binary_image': (lambda image: BinaryImage(image, kernel=5, grad_thresh=(20, 100),
+                                                   sat_thresh=(120, 255),
+                                                   light_thresh=(45, 255),
+                                                   mag_thresh=(30, 100),
+                                                   dir_thresh=(0.7, 1.3)).get(), undist),
+        'perspective_get': (lambda image: PerspectiveTransform(image).get(), binary),
+        'perspective_get_inverse': (lambda image: PerspectiveTransform(image).get_inverse(),
+                                    overlays),
+        'slide_window': (slide_window, perspective),
+        'visualize': (lambda finder: finder.visualize(), finders),
+        'process_image': (process_image, rgb),
+    }
+
+
+# video benchmark name to the VideoProcessor options it runs with, the keyframe run tracks
+# the lanes between keyframes at most 8 frames apart
+VIDEO_BENCHMARKS = {
+    'video': {},
+    'video_keyframes': {'track': True, 'keyframe_interval': 8},
+}
+
+
+def video_benchmark(cam_cal, img_size, n_frames, track=False, keyframe_interval=1):
+    ''' processes a synthetic video end to end, returns stage name to latency percentiles
+        from the stage timer records of the frames running that stage, 'total' also has fps
+        from wall time and the peak memory '''
+    with tempfile.TemporaryDirectory() as video_dir:
+        input_video = os.path.join(video_dir, 'synthetic.mp4')
+        write_synthetic_video(input_video, img_size, n_frames)
+        scheduler = KeyframeScheduler(1, keyframe_interval) if keyframe_interval > 1 else None
+        tracker = LaneTracker(cam_cal, profile=True, scheduler=scheduler)
+        processor = VideoProcessor(input_video, os.path.join(video_dir, 'output.mp4'), tracker,
+                                   track=track)
+        tracemalloc.start()
+        start = time.perf_counter()
+        processor.process()
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    records = tracker.timer.records
+    results = {}
+    for name in tracker.timer.stages + ['total']:
+        latencies = np.array([record[name] for record in records if name in record]) * 1000
+        results[name] = latency_result(latencies)
+    results['total']['fps'] = len(records) / wall
+    results['total']['peak_memory_mb'] = peak / 2 ** 20
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    ''' prints p50 latency against the baseline, returns the regressed benchmark names '''
+    regressions = []
+    click.echo('{:<40}{:>12}{:>12}{:>9}'.format('benchmark', 'base p50', 'p50', 'ratio'))
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            click.echo('{:<40}{:>12}{:>12.2f}{:>9}'.format(name, '-', result['p50_ms'], 'new'))
+            continue
+        ratio = result['p50_ms'] / base['p50_ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        click.echo('{:<40}{:>12.2f}{:>12.2f}{:>9.2f}{}'.format(name, base['p50_ms'],
+                                                             result['p50_ms'], ratio, flag))
+    return regressions
+
+
+benchmark_cli = click.Group()
+
+@benchmark_cli.command('run')
+@click.option('--input-dir', default='test_images', help='Input directory of test images.')
+@calibration_options
+@click.option('--resolutions', default='1280x720,640x360',
+              help='Comma separated WIDTHxHEIGHT sizes the images and video are scaled to.')
+@click.option('--repeat', default=5, help='Timed passes over the test images per stage.')
+@click.option('--video-frames', default=50, help='Frames of the synthetic video, 0 skips it.')
+@click.option('--stage', multiple=True, help='Run only this stage benchmark, may be repeated.')
+@click.option('--output', default='bench.json', help='Output JSON file of the results.')
+@click.option('--baseline', default=None, help='Baseline JSON file to compare against.')
+@click.option('--threshold', default=0.1,
+              help='Relative p50 latency increase over the baseline that counts as regression.')
+def run(input_dir, camera_input, camera_cal_dir, calibration_cache, resolutions, repeat,
+        video_frames, stage, output, baseline, threshold):
+    cam_cal = VideoProcessor.load_calibration(camera_input, camera_cal_dir, calibration_cache)
+    results = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'opencv': cv2.__version__, 'machine': platform.machine(),
+                        'processor': platform.processor(), 'cpus': os.cpu_count(),
+                        'repeat': repeat, 'video_frames': video_frames},
+               'results': {}}
+    for img_size in parse_resolutions(resolutions):
+        resolution = '{}x{}'.format(*img_size)
+        images = load_images(input_dir, img_size)
+        benchmarks = stage_benchmarks(cam_cal, images)
+        if len(benchmarks['undistort'][1]) < len(images):
+            click.echo('{}: lanes found in {} of {} images, using those'.format(
+                resolution, len(benchmarks['undistort'][1]), len(images)))
+        for name, (function, inputs) in benchmarks.items():
+            if stage and name not in stage or not inputs:
+                continue
+            result = measure(function, inputs, repeat)
+            results['results']['{}@{}'.format(name, resolution)] = result
+            click.echo('{:<32}{:>10.1f} fps  p50 {:8.2f} ms  p99 {:8.2f} ms  {:7.1f} MB'.format(
+                '{}@{}'.format(name, resolution), result['fps'], result['p50_ms'],
+                result['p99_ms'], result['peak_memory_mb']))
+        for video, options in VIDEO_BENCHMARKS.items():
+            if not video_frames or stage and video not in stage:
+                continue
+            stage_results = video_benchmark(cam_cal, img_size, video_frames, **options)
+            result = stage_results.pop('total')
+            results['results']['{}@{}'.format(video, resolution)] = result
+            click.echo('{:<32}{:>10.1f} fps  p50 {:8.2f} ms  p99 {:8.2f} ms  {:7.1f} MB'.format(
+                '{}@{}'.format(video, resolution), result['fps'], result['p50_ms'],
+                result['p99_ms'], result['peak_memory_mb']))
+            for name, result in stage_results.items():
+                name = '{}.{}@{}'.format(video, name, resolution)
+                results['results'][name] = result
+                click.echo('  {:<46}p50 {:8.2f} ms  p99 {:8.2f} ms  {:>4} frames'.format(
+                    name, result['p50_ms'], result['p99_ms'], result['samples']))
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=1)
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            regressions = compare_results(results, json.load(baseline_file), threshold)
+        if regressions:
+            raise click.ClickException('{} benchmarks regressed'.format(len(regressions)))
+
+@benchmark_cli.command('compare')
+@click.argument('results_file')
+@click.argument('baseline_file')
+@click.option('--threshold', default=0.1,
+              help='Relative p50 latency increase over the baseline that counts as regression.')
+def compare(results_file, baseline_file, threshold):
+    with open(results_file) as input_file:
+        results = json.load(input_file)
+    with open(baseline_file) as input_file:
+        baseline = json.load(input_file)
+    regressions = compare_results(results, baseline, threshold)
+    if regressions:
+        raise click.ClickException('{} benchmarks regressed'.format(len(regressions)))
+
+if __name__ == '__main__':
+    benchmark_cli()
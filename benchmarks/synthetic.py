@@ -0,0 +1,50 @@
+import cv2
+import numpy as np
+from utils.perspective_transform import PerspectiveTransform
+
+
+def synthetic_frame(img_size, index, seed=0):
+    ''' returns a BGR road frame of img_size (width, height) with two lane lines whose
+        curvature and position drift with index, the same for the same arguments '''
+    width, height = img_size
+    rng = np.random.default_rng(seed + index)
+    # bird-eyes view of the road: noisy asphalt, a solid yellow and a dashed white line
+    road = rng.normal(90, 12, (height, width, 3)).clip(0, 255).astype(np.uint8)
+    ploty = np.arange(0, height, 4, dtype=np.float64)
+    curve = 0.0003 * np.sin(index / 40.0) * (height - ploty) ** 2 / (height / 720.0)
+    shift = width * 0.02 * np.sin(index / 25.0)
+    line_width = max(int(width / 80), 2)
+    for x_base, color, dashed in ((width * 0.23, (0, 200, 230), False),
+                                  (width * 0.77, (235, 235, 235), True)):
+        points = np.column_stack((x_base + shift + curve * width / 1280.0, ploty))
+        points = points.astype(np.int32)
+        if not dashed:
+            cv2.polylines(road, [points], False, color, line_width)
+            continue
+        dash = max(len(points) // 8, 2)
+        offset = (index * 2) % (2 * dash)
+        for start in range(-offset, len(points), 2 * dash):
+            segment = points[max(start, 0):max(start + dash, 0)]
+            if len(segment) > 1:
+                cv2.polylines(road, [segment], False, color, line_width)
+    pers_img = PerspectiveTransform(road)
+    frame = pers_img.get_inverse()
+    # grass beside the road and sky above the area the perspective transform looks at
+    road_mask = PerspectiveTransform(np.full((height, width), 255, np.uint8)).get_inverse()
+    grass = rng.normal((60, 110, 80), 15, (height, width, 3)).clip(0, 255).astype(np.uint8)
+    frame[road_mask < 128] = grass[road_mask < 128]
+    horizon = pers_img.get_roi()[1]
+    sky = np.linspace(200, 140, horizon, dtype=np.float64)[:, None, None]
+    frame[:horizon] = np.broadcast_to(sky * np.array([1.0, 0.85, 0.7]),
+                                      (horizon, width, 3)).astype(np.uint8)
+    return frame
+
+
+def write_synthetic_video(filename, img_size, n_frames, fps=25, seed=0):
+    ''' writes n_frames synthetic road frames to filename with cv2.VideoWriter '''
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, img_size)
+    if not writer.isOpened():
+        raise Exception("Can't open output video {}.".format(filename))
+    for index in range(n_frames):
+        writer.write(synthetic_frame(img_size, index, seed))
+    writer.release()
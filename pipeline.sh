@@ -1,10 +1,6 @@
 #!/bin/sh
 python adv_lane_detection.py calibrate --input-dir camera_cal --output camera.p
-python adv_lane_detection.py undistort --camera-input camera.p --input-dir test_images --output-dir output_images/undist
-python adv_lane_detection.py binary-image --input-dir output_images/undist --output-dir output_images/binary
-python adv_lane_detection.py perspective-transform --input-dir output_images/binary --output-dir output_images/perspective
-python adv_lane_detection.py lane-finder --input-dir output_images/perspective --output-dir output_images/lanes
-python adv_lane_detection.py lane-visualizer --input-dir output_images/perspective --original-dir output_images/undist --output-dir output_images/final
+python adv_lane_detection.py pipeline --camera-input camera.p --input-dir test_images --output-dir output_images --save-stage undist --save-stage binary --save-stage perspective --save-stage lanes
 
 python adv_lane_detection.py test-undistort --input-file test_images/straight_lines1.jpg --output-file examples/test-undistort1.png --camera-input camera.p
 python adv_lane_detection.py test-undistort --input-file camera_cal/calibration1.jpg --output-file examples/test-undistort.png --camera-input camera.p
@@ -1,5 +1,12 @@
 from utils.camera_cal import CameraCalibration
 from utils.binary_image import BinaryImage
 from utils.perspective_transform import PerspectiveTransform
-from utils.lane_finder import LaneFinder
+from utils.keyframe_scheduler import KeyframeScheduler
+from utils.lane_finder import LaneFinder, LaneTracker, blend_polygon
+from utils.frame_pipeline import FramePipeline
+from utils.batch_processor import BatchProcessor
+from utils.debug_writer import DebugWriter
+from utils.metrics_writer import MetricsWriter
+from utils.profiler import StageTimer
+from utils.stream_processor import StreamProcessor
 from utils.video_processor import VideoProcessor
\ No newline at end of file
@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+from utils.binary_image import PREFILTERS, fast_votes, get_buffer, sobel_maxima
+from utils.perspective_transform import PerspectiveTransform
+
+
+class BatchProcessor:
+    ''' runs the per pixel stages on a stack of frames at once
+
+    Frames are an (N, H, W, 3) BGR array. Color conversion and threshold voting run once over
+    the whole stack, spatial filters run frame by frame into slices of the same preallocated
+    buffers. Votes are the fast engine ones, equal to BinaryImage with engine='fast'.
+    roi is an (x0, y0, x1, y1) box or a PerspectiveTransform, as for BinaryImage.
+    '''
+    def __init__(self, kernel=5, grad_thresh=(0, 255), sat_thresh=(0, 255),
+                 light_thresh=(0, 255), jet_thresh=200, mag_thresh=(0, 255),
+                 dir_thresh=(0, np.pi/2), roi=None, prefilter='bilateral', buffers=None):
+        if prefilter not in PREFILTERS:
+            raise Exception("Invalid pre-filter {}.".format(prefilter))
+        if roi is not None and hasattr(roi, 'get_roi'):
+            roi = roi.get_roi()
+        self.kernel = kernel
+        self.grad_thresh = grad_thresh
+        self.sat_thresh = sat_thresh
+        self.light_thresh = light_thresh
+        self.jet_thresh = jet_thresh
+        self.mag_thresh = mag_thresh
+        self.dir_thresh = dir_thresh
+        self.roi = roi
+        self.prefilter = PREFILTERS[prefilter]
+        self.buffers = buffers if buffers is not None else {}
+
+    def get_buffer(self, name, shape, dtype):
+        ''' returns a reusable batch buffer, reallocated only when shape or dtype changes '''
+        return get_buffer(self.buffers, name, shape, dtype)
+
+    def threshold(self, frames, output=None):
+        ''' returns the (N, H, W) binary images of frames, 255 where a pixel has more than two
+            votes, written into output when a buffer of the right shape is given '''
+        count, height, width = frames.shape[:3]
+        binary = output if output is not None else np.empty((count, height, width), np.uint8)
+        region = binary
+        inner = (slice(None), slice(None))
+        if self.roi is not None:
+            # thresholds only inside the box, normalized by the maxima of the whole frames
+            x0, y0, x1, y1 = self.roi
+            inner = (slice(y0, y1), slice(x0, x1))
+            binary.fill(0)
+            region = binary[:, y0:y1, x0:x1]
+        shape = frames.shape[:3]
+
+        filtered = self.get_buffer('batch_filtered', shape + (3,), np.uint8)
+        for index in range(count):
+            filtered[index] = self.prefilter(frames[index], self.kernel)
+        # color conversions are per pixel, so the stack converts as one tall image
+        rows = (shape[0] * shape[1], shape[2])
+        hls = self.get_buffer('batch_hls', shape + (3,), np.uint8)
+        gray = self.get_buffer('batch_gray', shape, np.uint8)
+        cv2.cvtColor(filtered.reshape(rows + (3,)), cv2.COLOR_BGR2HLS, dst=hls.reshape(rows + (3,)))
+        cv2.cvtColor(hls.reshape(rows + (3,)), cv2.COLOR_BGR2GRAY, dst=gray.reshape(rows))
+        jet = cv2.applyColorMap(gray.reshape(rows), cv2.COLORMAP_JET)[:, :, 2].reshape(shape)
+
+        sobelx = self.get_buffer('batch_sobelx', shape, np.int16)
+        sobely = self.get_buffer('batch_sobely', shape, np.int16)
+        for index in range(count):
+            cv2.Sobel(gray[index], cv2.CV_16S, 1, 0, dst=sobelx[index], ksize=self.kernel)
+            cv2.Sobel(gray[index], cv2.CV_16S, 0, 1, dst=sobely[index], ksize=self.kernel)
+        np.absolute(sobelx, out=sobelx)
+        np.absolute(sobely, out=sobely)
+
+        crop = (slice(None),) + inner
+        maxima = sobel_maxima(sobelx, sobely) if self.roi is not None else None
+        votes = fast_votes(sobelx[crop], sobely[crop], hls[crop + (2,)], hls[crop + (1,)],
+                           jet[crop], self.grad_thresh, self.sat_thresh, self.light_thresh,
+                           self.jet_thresh, self.mag_thresh, self.dir_thresh, self.buffers,
+                           maxima)
+        mask = self.get_buffer('binary_mask', votes.shape, np.bool_)
+        np.greater(votes, 2, out=mask)
+        np.multiply(mask, 255, out=region, casting='unsafe')
+        return binary
+
+    @staticmethod
+    def warp(images, output=None, cam_cal=None, use_maps=False):
+        ''' returns the bird-eyes view of every image of the stack, images thresholded before
+            undistortion are undistorted on the way when cam_cal is given, use_maps warps with
+            cached remap tables '''
+        if output is None:
+            output = np.empty_like(images)
+        for index in range(images.shape[0]):
+            if cam_cal is not None:
+                PerspectiveTransform(images[index], cam_cal).get(output[index])
+            else:
+                PerspectiveTransform(images[index], use_maps=use_maps).get(output[index])
+        return output
+
+    @staticmethod
+    def find_lane_starts(images):
+        ''' returns the (N, W) histograms of the lower halves of binary bird-eyes images and
+            the left and right lane start of each image '''
+        height, width = images.shape[1:3]
+        histograms = np.sum(images[:, height//2:, :], axis=1)
+        midpoint = width // 2
+        left_starts = np.argmax(histograms[:, :midpoint], axis=1)
+        right_starts = np.argmax(histograms[:, midpoint:], axis=1) + midpoint
+        return histograms, left_starts, right_starts
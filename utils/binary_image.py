@@ -1,36 +1,210 @@
+import math
 import cv2
 import numpy as np
 
+
+def get_buffer(buffers, name, shape, dtype):
+    ''' returns buffers[name] when it matches shape and dtype, allocating it otherwise '''
+    if buffers is None:
+        return np.empty(shape, dtype)
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype)
+        buffers[name] = buffer
+    return buffer
+
+
+def bilateral_filter(image, kernel):
+    ''' edge preserving bilateral filter, the reference pre-filter '''
+    return cv2.bilateralFilter(image, kernel*2, 60, 120)
+
+
+def downscaled_bilateral_filter(image, kernel):
+    ''' bilateral filter on a half size image, upsampled back to the input size '''
+    small = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2),
+                       interpolation=cv2.INTER_AREA)
+    small = cv2.bilateralFilter(small, kernel, 60, 120)
+    return cv2.resize(small, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_LINEAR)
+
+
+def gaussian_filter(image, kernel):
+    ''' gaussian blur with an odd kernel of about the bilateral filter radius '''
+    size = kernel | 1
+    return cv2.GaussianBlur(image, (size, size), 0)
+
+
+def box_filter(image, kernel):
+    ''' normalized box blur of kernel x kernel pixels '''
+    return cv2.blur(image, (kernel, kernel))
+
+
+def no_filter(image, kernel):
+    ''' returns the image unchanged '''
+    return image
+
+
+PREFILTERS = {
+    'bilateral': bilateral_filter,
+    'bilateral-downscaled': downscaled_bilateral_filter,
+    'gaussian': gaussian_filter,
+    'box': box_filter,
+    'none': no_filter,
+}
+
+
+def sobel_maxima(abs_sobelx, abs_sobely):
+    ''' returns the maxima of |sobel x| and of the gradient magnitude of each frame, the
+        normalization of the fast engine thresholds '''
+    frame_axes = (-2, -1)
+    max_x = np.max(abs_sobelx, axis=frame_axes, keepdims=True).astype(np.int64)
+    square = np.square(abs_sobelx, dtype=np.float32)
+    np.add(square, np.square(abs_sobely, dtype=np.float32), out=square)
+    return max_x, np.sqrt(np.max(square, axis=frame_axes, keepdims=True))
+
+
+def fast_votes(abs_sobelx, abs_sobely, s_channel, l_channel, jet_color, grad_thresh, sat_thresh,
+               light_thresh, jet_thresh, mag_thresh, dir_thresh, buffers=None, maxima=None):
+    ''' computes the same votes as the reference thresholds from int16 sobel magnitudes
+
+    Normalization is folded into integer/float32 thresholds, so no scaled images are built.
+    Leading axes are treated as a batch of frames, each normalized by its own maximum, or by
+    maxima from sobel_maxima when the inputs are crops of larger frames.
+    '''
+    shape = abs_sobelx.shape
+    votes = get_buffer(buffers, 'binary_votes', shape, np.uint8)
+    mask = get_buffer(buffers, 'binary_mask', shape, np.bool_)
+    temp = get_buffer(buffers, 'binary_temp', shape, np.bool_)
+    scratch = get_buffer(buffers, 'binary_scratch', shape, np.float32)
+    votes.fill(0)
+
+    # color: (saturation & lightness) | jet
+    np.greater_equal(s_channel, sat_thresh[0], out=mask)
+    np.logical_and(mask, np.less_equal(s_channel, sat_thresh[1], out=temp), out=mask)
+    np.logical_and(mask, np.greater_equal(l_channel, light_thresh[0], out=temp), out=mask)
+    np.logical_and(mask, np.less_equal(l_channel, light_thresh[1], out=temp), out=mask)
+    np.logical_or(mask, np.greater_equal(jet_color, jet_thresh, out=temp), out=mask)
+    np.add(votes, 2, out=votes, where=mask)
+
+    # gradient: uint8(255*|sx|/max) in [t0, t1] as integer bounds on |sx|
+    if maxima is None:
+        maxima = sobel_maxima(abs_sobelx, abs_sobely)
+    max_x, max_mag = maxima
+    low = -(-grad_thresh[0] * max_x // 255)
+    high = ((grad_thresh[1] + 1) * max_x - 1) // 255
+    np.greater_equal(abs_sobelx, low, out=mask)
+    np.logical_and(mask, np.less_equal(abs_sobelx, high, out=temp), out=mask)
+    np.add(votes, 2, out=votes, where=mask)
+
+    # magnitude: compare squared magnitude, the reference int8 cast drops values above 127
+    np.multiply(abs_sobelx, abs_sobelx, out=scratch, dtype=np.float32)
+    np.add(scratch, np.square(abs_sobely, dtype=np.float32), out=scratch)
+    low = (max(mag_thresh[0], 0) * max_mag / 255.0) ** 2
+    high = ((min(mag_thresh[1], 127) + 1) * max_mag / 255.0) ** 2
+    np.greater_equal(scratch, low, out=mask)
+    np.logical_and(mask, np.less(scratch, high, out=temp), out=mask)
+    np.add(votes, 1, out=votes, where=mask)
+
+    # direction: arctan2(|sy|, |sx|) in [t0, t1] as |sy| against tan(t) * |sx|
+    mask.fill(True)
+    if dir_thresh[0] > 0:
+        np.multiply(abs_sobelx, math.tan(dir_thresh[0]), out=scratch, dtype=np.float32)
+        np.greater_equal(abs_sobely, scratch, out=mask)
+        np.logical_and(mask, np.greater(abs_sobely, 0, out=temp), out=mask)
+    if dir_thresh[1] < np.pi / 2:
+        np.multiply(abs_sobelx, math.tan(dir_thresh[1]), out=scratch, dtype=np.float32)
+        np.logical_and(mask, np.less_equal(abs_sobely, scratch, out=temp), out=mask)
+    np.add(votes, 1, out=votes, where=mask)
+    return votes
+
+
 class BinaryImage:
-    ''' build a binary image from input image which is best for lane detecction'''
+    ''' build a binary image from input image which is best for lane detecction
+
+    roi is an (x0, y0, x1, y1) box or a PerspectiveTransform whose warp input box is used,
+    thresholds are computed only inside it and the rest of the binary image is zero. Filters
+    and gradients still run over the whole frame, whose gradient maxima normalize the
+    thresholds, so the box holds the same pixels as without roi.
+    engine 'fast' computes the same votes with int16/float32 data into reusable buffers.
+    prefilter selects the smoothing applied before thresholding, one of PREFILTERS.
+    '''
     def __init__(self, image, kernel=5, grad_thresh=(0, 255),
                  sat_thresh=(0, 255), light_thresh=(0, 255), jet_thresh=200,
-                 mag_thresh=(0, 255), dir_thresh=(0, np.pi/2)):
-        image = cv2.bilateralFilter(image, kernel*2, 60, 120)
+                 mag_thresh=(0, 255), dir_thresh=(0, np.pi/2), roi=None,
+                 engine='reference', buffers=None, prefilter='bilateral'):
+        self.shape = image.shape[:2]
+        self.buffers = buffers
+        if roi is not None and hasattr(roi, 'get_roi'):
+            roi = roi.get_roi()
+        self.roi = roi
+        inner = None
+        if roi is not None:
+            inner = (slice(roi[1], roi[3]), slice(roi[0], roi[2]))
+        if prefilter not in PREFILTERS:
+            raise Exception("Invalid pre-filter {}.".format(prefilter))
+        image = PREFILTERS[prefilter](image, kernel)
         self.image = cv2.cvtColor(image, cv2.COLOR_BGR2HLS)
-        self.s_channel = self.image[:, :, 2]
-        self.l_channel = self.image[:, :, 1]
         self.gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-        self.jet_color = cv2.applyColorMap(self.gray, cv2.COLORMAP_JET)
-        self.jet_color = self.jet_color[:, :, 2]
         self.abs_sobelx = None
         self.abs_sobely = None
         self.scaled_sobelx = None
         self.scaled_sobely = None
-        self._compute_sobel(kernel)
-        self.vote_binary = np.zeros_like(self.gray)
-        self.grad_binary = self._abs_sobel_thresh(grad_thresh, light_thresh)
-        self.color_binary = self._color_thresh(sat_thresh, light_thresh, jet_thresh)
-        self.mag_binary = self._mag_thresh(mag_thresh, light_thresh)
-        self.dir_binary = self._dir_thresh(dir_thresh, light_thresh)
-
-    def _compute_sobel(self, kernel):
+        self.maxima = None
+        self.max_mag = None
+        if engine == 'fast':
+            self._compute_sobel_16s(kernel, inner)
+        else:
+            self._compute_sobel(kernel, inner)
+        if inner is not None:
+            self.image = self.image[inner]
+            self.gray = self.gray[inner]
+        self.s_channel = self.image[:, :, 2]
+        self.l_channel = self.image[:, :, 1]
+        self.jet_color = cv2.applyColorMap(self.gray, cv2.COLORMAP_JET)
+        self.jet_color = self.jet_color[:, :, 2]
+        if engine == 'fast':
+            self.grad_binary = None
+            self.color_binary = None
+            self.mag_binary = None
+            self.dir_binary = None
+            self.vote_binary = fast_votes(self.abs_sobelx, self.abs_sobely, self.s_channel,
+                                          self.l_channel, self.jet_color, grad_thresh,
+                                          sat_thresh, light_thresh, jet_thresh, mag_thresh,
+                                          dir_thresh, buffers, self.maxima)
+        elif engine == 'reference':
+            self.vote_binary = np.zeros_like(self.gray)
+            self.grad_binary = self._abs_sobel_thresh(grad_thresh, light_thresh)
+            self.color_binary = self._color_thresh(sat_thresh, light_thresh, jet_thresh)
+            self.mag_binary = self._mag_thresh(mag_thresh, light_thresh)
+            self.dir_binary = self._dir_thresh(dir_thresh, light_thresh)
+        else:
+            raise Exception("Invalid threshold engine {}.".format(engine))
+
+    def _compute_sobel_16s(self, kernel, inner=None):
+        sobelx = cv2.Sobel(self.gray, cv2.CV_16S, 1, 0, ksize=kernel)
+        sobely = cv2.Sobel(self.gray, cv2.CV_16S, 0, 1, ksize=kernel)
+        self.abs_sobelx = np.absolute(sobelx, out=sobelx)
+        self.abs_sobely = np.absolute(sobely, out=sobely)
+        if inner is not None:
+            self.maxima = sobel_maxima(self.abs_sobelx, self.abs_sobely)
+            self.abs_sobelx = self.abs_sobelx[inner]
+            self.abs_sobely = self.abs_sobely[inner]
+
+    def _compute_sobel(self, kernel, inner=None):
         sobelx = cv2.Sobel(self.gray, cv2.CV_64F, 1, 0, ksize=kernel)
-        self.abs_sobelx = np.absolute(sobelx)
-        self.scaled_sobelx = np.uint8(255*self.abs_sobelx/np.max(self.abs_sobelx))
         sobely = cv2.Sobel(self.gray, cv2.CV_64F, 0, 1, ksize=kernel)
-        self.abs_sobely = np.absolute(sobely)
-        self.scaled_sobely = np.uint8(255*self.abs_sobely/np.max(self.abs_sobely))
+        abs_sobelx = np.absolute(sobelx)
+        abs_sobely = np.absolute(sobely)
+        # normalized by the maxima of the whole frame, also when only the box is thresholded
+        max_x = np.max(abs_sobelx)
+        max_y = np.max(abs_sobely)
+        if inner is not None:
+            self.max_mag = np.max(np.sqrt(abs_sobelx*abs_sobelx + abs_sobely*abs_sobely))
+            abs_sobelx = abs_sobelx[inner]
+            abs_sobely = abs_sobely[inner]
+        self.abs_sobelx = abs_sobelx
+        self.scaled_sobelx = np.uint8(255*self.abs_sobelx/max_x)
+        self.abs_sobely = abs_sobely
+        self.scaled_sobely = np.uint8(255*self.abs_sobely/max_y)
 
     def _color_thresh(self, sat_thresh, light_thresh, jet_thresh):
         color_binary = np.zeros_like(self.s_channel)
@@ -50,7 +224,8 @@ class BinaryImage:
 
     def _mag_thresh(self, thresh, light_thresh):
         mag = np.sqrt(self.abs_sobelx*self.abs_sobelx + self.abs_sobely*self.abs_sobely)
-        scaled_mag = np.int8(255.0*mag/np.max(mag))
+        max_mag = self.max_mag if self.max_mag is not None else np.max(mag)
+        scaled_mag = np.int8(255.0*mag/max_mag)
         mag_binary = np.zeros_like(scaled_mag)
         cond = ((scaled_mag >= thresh[0]) & (scaled_mag <= thresh[1]))
         mag_binary[cond] = 1
@@ -65,11 +240,15 @@ class BinaryImage:
         self.vote_binary[cond] += 1
         return dir_binary
 
-    def get(self):
-        ''' returns binary representation of an input image '''
-        img_binary = np.zeros_like(self.gray)
-        cond1 = (self.color_binary == 1) | \
-               ((self.grad_binary == 1) | ((self.dir_binary == 1) & (self.mag_binary == 1)))
-        cond2 = (self.vote_binary > 2)
-        img_binary[cond2] = 1
-        return img_binary*255
+    def get(self, output=None):
+        ''' returns binary representation of an input image,
+            written into output when a buffer of the right shape is given '''
+        img_binary = output if output is not None else np.empty(self.shape, np.uint8)
+        region = img_binary
+        if self.roi is not None:
+            img_binary.fill(0)
+            region = img_binary[self.roi[1]:self.roi[3], self.roi[0]:self.roi[2]]
+        mask = get_buffer(self.buffers, 'binary_mask', self.vote_binary.shape, np.bool_)
+        np.greater(self.vote_binary, 2, out=mask)
+        np.multiply(mask, 255, out=region, casting='unsafe')
+        return img_binary
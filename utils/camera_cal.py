@@ -2,49 +2,155 @@ import cv2
 import pickle
 import numpy as np
 import click
+from concurrent.futures import ThreadPoolExecutor
+
+CHESSBOARD_SIZE = (9, 6)
+COARSE_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+# part of the calibration cache key, increase it whenever corner detection, the calibration or
+# the saved file format change
+CALIBRATION_VERSION = 1
+
+
+def find_chessboard_corners(image, scale=0.5):
+    ''' finds chessboard corners on a copy downscaled by scale and refines them with
+        cornerSubPix at full resolution, returns None when the coarse pass finds no board '''
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = gray
+    if scale != 1:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ret, corners = cv2.findChessboardCorners(small, CHESSBOARD_SIZE, flags=COARSE_FLAGS)
+    if not ret:
+        return None
+    # map pixel centers of the small image back to the full resolution grid
+    corners = (corners + 0.5) / scale - 0.5
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), SUBPIX_CRITERIA)
+
 
 class CameraCalibration:
     ''' This class computes camera calibration parameters '''
     def __init__(self):
         self.mtx = None
         self.dist = None
+        self.maps = {}
+        self.warp_maps = {}
+        self.report = []
+
+    def compute(self, img_list, force=False, scale=0.5, jobs=None, names=None):
+        ''' computes camera parameters, corners of the images are found by up to jobs threads
 
-    def compute(self, img_list, force=False):
-        ''' computes camera parameters '''
+        report gets a (name, reprojection error) pair per image, the error is None for images
+        without a detected board, which are not used.
+        '''
         if not force and self.mtx is not None and self.dist is not None:
             return
-        imgpoints = []
-        objpoints = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            found = list(executor.map(lambda img: find_chessboard_corners(img, scale), img_list))
+        self.compute_from_corners(found, (img_list[-1].shape[1], img_list[-1].shape[0]), names)
 
-        objp = np.zeros((9*6, 3), np.float32)
-        objp[:, :2] = np.mgrid[0:9, 0:6].T.reshape(-1, 2)
-        for img in img_list:
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            ret, corners = cv2.findChessboardCorners(gray, (9, 6), None)
+    def compute_from_corners(self, found, img_size, names=None):
+        ''' computes camera parameters from the chessboard corners found in images of img_size
+            (width, height), None for an image without a detected board, and fills report like
+            compute '''
+        if names is None:
+            names = [str(index) for index in range(len(found))]
+        imgpoints = [corners for corners in found if corners is not None]
+        if not imgpoints:
+            raise Exception("No chessboard found in calibration images.")
 
-            if ret:
-                imgpoints.append(corners)
-                objpoints.append(objp)
-        _, self.mtx, self.dist, _, _ = cv2.calibrateCamera(objpoints, imgpoints,
-                                                           gray.shape[::-1], None, None)
+        objp = np.zeros((CHESSBOARD_SIZE[0]*CHESSBOARD_SIZE[1], 3), np.float32)
+        objp[:, :2] = np.mgrid[0:CHESSBOARD_SIZE[0], 0:CHESSBOARD_SIZE[1]].T.reshape(-1, 2)
+        objpoints = [objp] * len(imgpoints)
+        _, self.mtx, self.dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints,
+                                                                   img_size, None, None)
+        self.report = []
+        used = iter(zip(imgpoints, rvecs, tvecs))
+        for name, corners in zip(names, found):
+            error = None
+            if corners is not None:
+                corners, rvec, tvec = next(used)
+                projected, _ = cv2.projectPoints(objp, rvec, tvec, self.mtx, self.dist)
+                residuals = projected.reshape(-1, 2) - corners.reshape(-1, 2)
+                error = float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1))))
+            self.report.append((name, error))
+        self.maps = {}
+        self.warp_maps = {}
+        self.get_undistort_maps(img_size)
 
     def save(self, filename):
-        ''' saves the mtx and dist parameters to a binary file '''
+        ''' saves the mtx and dist parameters and undistortion maps to a binary file '''
         with open(filename, 'wb') as output:
-            pickle.dump([self.mtx, self.dist], output)
+            pickle.dump([self.mtx, self.dist, self.maps], output)
 
     def load(self, filename):
-        ''' loads the mtx and dist parameters from a binary file '''
+        ''' loads the mtx and dist parameters and undistortion maps from a binary file '''
         with open(filename, 'rb') as input_file:
             data = pickle.load(input_file)
             self.mtx = data[0]
             self.dist = data[1]
+            self.maps = data[2] if len(data) > 2 else {}
+            self.warp_maps = {}
+
+    def get_undistort_maps(self, img_size):
+        ''' returns fixed-point remap tables for img_size (width, height), built once '''
+        img_size = tuple(img_size)
+        maps = self.maps.get(img_size)
+        if maps is None:
+            maps = cv2.initUndistortRectifyMap(self.mtx, self.dist, None, self.mtx,
+                                               img_size, cv2.CV_16SC2)
+            self.maps[img_size] = maps
+        return maps
+
+    def get_warp_maps(self, img_size, M, dst_size=None):
+        ''' returns remap tables which undistort and then warp by M in a single pass '''
+        img_size = tuple(img_size)
+        dst_size = tuple(dst_size) if dst_size is not None else img_size
+        key = ('warp', img_size, dst_size, M.tobytes())
+        maps = self.warp_maps.get(key)
+        if maps is None:
+            # undistorted source position of every output pixel
+            grid = np.mgrid[0:dst_size[1], 0:dst_size[0]].astype(np.float32)
+            points = np.dstack((grid[1], grid[0])).reshape(-1, 1, 2)
+            points = cv2.perspectiveTransform(points, np.linalg.inv(M))
+            # distort it again to find where it lies in the raw frame
+            distorted = self.distort_points(points)
+            distorted = distorted.reshape(dst_size[1], dst_size[0], 2).astype(np.float32)
+            maps = cv2.convertMaps(distorted, None, cv2.CV_16SC2)
+            self.warp_maps[key] = maps
+        return maps
+
+    def distort_points(self, points):
+        ''' maps undistorted pixel positions, an (N, 2) or (N, 1, 2) array, to the raw frame '''
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        rays = np.ones((points.shape[0], 1, 3), np.float64)
+        rays[:, 0, 0] = (points[:, 0] - self.mtx[0, 2]) / self.mtx[0, 0]
+        rays[:, 0, 1] = (points[:, 1] - self.mtx[1, 2]) / self.mtx[1, 1]
+        distorted, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), self.mtx, self.dist)
+        return distorted.reshape(-1, 2)
+
+    def get_unwarp_maps(self, img_size, M, src_size=None):
+        ''' returns remap tables which take a warped image back to the raw, distorted frame '''
+        img_size = tuple(img_size)
+        src_size = tuple(src_size) if src_size is not None else img_size
+        key = ('unwarp', img_size, src_size, M.tobytes())
+        maps = self.warp_maps.get(key)
+        if maps is None:
+            grid = np.mgrid[0:img_size[1], 0:img_size[0]].astype(np.float32)
+            points = np.dstack((grid[1], grid[0])).reshape(-1, 1, 2)
+            points = cv2.undistortPoints(points, self.mtx, self.dist, P=self.mtx)
+            points = cv2.perspectiveTransform(points, M)
+            points = points.reshape(img_size[1], img_size[0], 2).astype(np.float32)
+            maps = cv2.convertMaps(points, None, cv2.CV_16SC2)
+            self.warp_maps[key] = maps
+        return maps
 
-    def undistort(self, image):
-        ''' get an image and return undistorted version of it '''
+    def undistort(self, image, output=None):
+        ''' get an image and return undistorted version of it,
+            written into output when a buffer of the right shape is given '''
         if self.dist is None or self.mtx is None:
             return None
-        return cv2.undistort(image, self.mtx, self.dist, None, self.mtx)
+        map1, map2 = self.get_undistort_maps((image.shape[1], image.shape[0]))
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=output)
 
     def visualize(self, image):
         ''' visualize undistortion effect '''
@@ -0,0 +1,80 @@
+import click
+from utils.binary_image import PREFILTERS
+
+
+def add_options(command, options):
+    ''' applies click options to command so they are listed in the given order '''
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def jobs_options(command):
+    ''' adds the shared --jobs and --max-in-flight options of directory commands '''
+    return add_options(command, [
+        click.option('--jobs', default=1, help='Number of processes working on files.'),
+        click.option('--max-in-flight', default=0,
+                     help='Files submitted but not yet written, twice --jobs by default.'),
+    ])
+
+
+def keyframe_options(command):
+    ''' adds the keyframe scheduler options of video commands '''
+    return add_options(command, [
+        click.option('--keyframe-interval', default=1,
+                     help='Longest run of frames between full detections, 1 detects every frame.'),
+        click.option('--keyframe-subsample', default=2,
+                     help='Between keyframes track the lanes on a binary image subsampled by '
+                          'this factor, 0 holds the last fits.'),
+        click.option('--keyframe-shift', default=15.0,
+                     help='Lane shift in bird-eyes pixels that shortens the keyframe interval.'),
+        click.option('--keyframe-curve', default=1e-3,
+                     help='Curvature change in 1/m that shortens the keyframe interval.'),
+    ])
+
+
+def calibration_options(command):
+    ''' adds the options of commands loading or computing the cached camera calibration, see
+        VideoProcessor.load_calibration '''
+    return add_options(command, [
+        click.option('--camera-input', default=None,
+                     help='Input camera parameters filename, calibrates from --camera-cal-dir '
+                          'if omitted.'),
+        click.option('--camera-cal-dir', default='camera_cal',
+                     help='Input directory of camera calibration images.'),
+        click.option('--calibration-cache', default='.calibration_cache',
+                     help='Directory of cached calibrations keyed by calibration image set.'),
+    ])
+
+
+PROCESSING_OPTIONS = {
+    'fused_warp': click.option('--fused-warp', is_flag=True,
+                               help='Threshold the raw frame, then undistort and warp the binary '
+                                    'image with one composite remap.'),
+    'roi': click.option('--roi', is_flag=True,
+                        help='Threshold only the region read by the perspective transform.'),
+    'threshold_engine': click.option('--threshold-engine', default='reference',
+                                     type=click.Choice(['reference', 'fast']),
+                                     help='Threshold implementation, fast gives the same votes '
+                                          'on int16/float32 data.'),
+    'prefilter': click.option('--prefilter', default='bilateral',
+                              type=click.Choice(sorted(PREFILTERS)),
+                              help='Smoothing applied before thresholding.'),
+    'track': click.option('--track', is_flag=True,
+                          help='Search around the previous lane fit, sliding windows only when '
+                               'that fails.'),
+    'work_scale': click.option('--work-scale', default=1,
+                               help='Threshold and search lanes on frames subsampled to 1/N of '
+                                    'the resolution.'),
+}
+
+
+def processing_options(*names):
+    ''' returns a decorator adding the VideoProcessor options of names, all but work_scale
+        when none are given '''
+    if not names:
+        names = ('fused_warp', 'roi', 'threshold_engine', 'prefilter', 'track')
+
+    def decorator(command):
+        return add_options(command, [PROCESSING_OPTIONS[name] for name in names])
+    return decorator
@@ -0,0 +1,91 @@
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+
+class DebugWriter:
+    ''' writes intermediate images of sampled frames from a background thread
+
+    Every every-th frame the selected stages are copied and queued, the queue holds at most
+    queue_size frames and frames arriving while it is full are dropped instead of waiting.
+    image_format is 'png' (fast compression), 'jpg' or 'npz', which stores all stages of a
+    frame in one compressed archive. The thread starts with the first frame, so an unused
+    writer can be pickled into worker processes.
+    '''
+    STAGES = ('original', 'undist', 'binary', 'perspective', 'lanes', 'final')
+    FORMATS = ('png', 'jpg', 'npz')
+
+    def __init__(self, debug_dir, stages=STAGES, image_format='png', every=10, queue_size=8,
+                 png_compression=1, jpeg_quality=90):
+        for stage in stages:
+            if stage not in DebugWriter.STAGES:
+                raise Exception("Invalid debug stage {}.".format(stage))
+        if image_format not in DebugWriter.FORMATS:
+            raise Exception("Invalid debug image format {}.".format(image_format))
+        self.debug_dir = debug_dir
+        self.stages = tuple(stages)
+        self.image_format = image_format
+        self.every = every
+        self.queue_size = queue_size
+        self.params = []
+        if image_format == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        elif image_format == 'jpg':
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.written = 0
+        self.dropped = 0
+        self.queue = None
+        self.thread = None
+        if image_format == 'npz':
+            os.makedirs(debug_dir, exist_ok=True)
+        else:
+            for stage in self.stages:
+                os.makedirs(os.path.join(debug_dir, stage), exist_ok=True)
+
+    def wants(self, frame_number, stage=None):
+        ''' returns whether frame_number is sampled, and stage selected when given '''
+        return frame_number % self.every == 0 and (stage is None or stage in self.stages)
+
+    def submit(self, frame_number, images):
+        ''' queues copies of the selected stages of images, a dict of stage name to image,
+            returns False when the frame was dropped because the queue is full '''
+        if self.thread is None:
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.thread = threading.Thread(target=self._write, daemon=True)
+            self.thread.start()
+        if self.queue.full():
+            self.dropped += 1
+            return False
+        # stages may live in buffers reused by the next frame
+        images = {stage: np.array(images[stage]) for stage in self.stages}
+        try:
+            self.queue.put_nowait((frame_number, images))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame_number, images = item
+            if self.image_format == 'npz':
+                np.savez_compressed(os.path.join(self.debug_dir, '{}.npz'.format(frame_number)),
+                                    **images)
+            else:
+                filename = '{}.{}'.format(frame_number, self.image_format)
+                for stage, image in images.items():
+                    cv2.imwrite(os.path.join(self.debug_dir, stage, filename), image, self.params)
+            self.written += 1
+
+    def close(self):
+        ''' waits until the queued frames are written and stops the thread '''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class FramePipeline:
+    ''' decodes, processes and encodes a video in three overlapping stages
+
+    A reader thread decodes frames with cv2.VideoCapture, the calling thread runs process_frame
+    on them and a writer thread encodes the results with ffmpeg in codec, through the moviepy
+    writer the segmented processing uses too. The stages are connected by bounded queues,
+    frames are BGR as OpenCV reads them and converted to RGB for ffmpeg. With batch_size
+    above one process_frame gets an (N, H, W, 3) stack of up to batch_size frames and returns a
+    stack of the same length. Without output_video there is no writer thread and the results of
+    process_frame are dropped.
+    '''
+    def __init__(self, input_video, output_video, process_frame, read_queue_size=8,
+                 write_queue_size=8, codec='libx264', batch_size=1):
+        self.input_video = input_video
+        self.output_video = output_video
+        self.process_frame = process_frame
+        self.read_queue = queue.Queue(maxsize=read_queue_size)
+        self.write_queue = queue.Queue(maxsize=write_queue_size)
+        self.codec = codec
+        self.batch_size = batch_size
+        self.fps = None
+        self.busy = {'read': 0.0, 'process': 0.0, 'write': 0.0}
+        self.frames = 0
+        self.errors = []
+        self.stop = threading.Event()
+
+    def _put(self, frame_queue, item):
+        ''' puts item on frame_queue unless the pipeline is stopping '''
+        while not self.stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, frame_queue):
+        ''' returns the next item of frame_queue, None once the pipeline is stopping '''
+        while True:
+            try:
+                return frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return None
+
+    def _read(self, capture):
+        try:
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                ret, frame = capture.read()
+                self.busy['read'] += time.perf_counter() - start
+                if not ret or not self._put(self.read_queue, frame):
+                    break
+        except Exception as error:
+            self.errors.append(error)
+            self.stop.set()
+        finally:
+            capture.release()
+            self._put(self.read_queue, None)
+
+    def _write(self):
+        from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+        writer = None
+        try:
+            while True:
+                frame = self._get(self.write_queue)
+                if frame is None:
+                    break
+                start = time.perf_counter()
+                if writer is None:
+                    writer = FFMPEG_VideoWriter(self.output_video,
+                                                (frame.shape[1], frame.shape[0]), self.fps,
+                                                codec=self.codec)
+                writer.write_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                self.busy['write'] += time.perf_counter() - start
+        except Exception as error:
+            self.errors.append(error)
+            self.stop.set()
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def run(self):
+        ''' processes the whole input video, returns the busy fraction of each stage '''
+        capture = cv2.VideoCapture(self.input_video)
+        if not capture.isOpened():
+            raise Exception("Can't open input video {}.".format(self.input_video))
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        reader = threading.Thread(target=self._read, args=(capture,), daemon=True)
+        writer = None
+        if self.output_video is not None:
+            writer = threading.Thread(target=self._write, daemon=True)
+        wall_start = time.perf_counter()
+        reader.start()
+        if writer is not None:
+            writer.start()
+        try:
+            batch = []
+            running = True
+            while running:
+                frame = self._get(self.read_queue)
+                if frame is not None:
+                    batch.append(frame)
+                    if len(batch) < self.batch_size:
+                        continue
+                running = frame is not None
+                if not batch:
+                    break
+                start = time.perf_counter()
+                if self.batch_size > 1:
+                    outputs = self.process_frame(np.stack(batch))
+                else:
+                    outputs = [self.process_frame(batch[0])]
+                self.busy['process'] += time.perf_counter() - start
+                self.frames += len(batch)
+                batch = []
+                if writer is None:
+                    continue
+                for output in outputs:
+                    if not self._put(self.write_queue, output):
+                        running = False
+                        break
+        except BaseException:
+            self.stop.set()
+            raise
+        finally:
+            if writer is not None:
+                self._put(self.write_queue, None)
+                writer.join()
+            self.stop.set()
+            reader.join()
+        if self.errors:
+            raise self.errors[0]
+        wall = time.perf_counter() - wall_start
+        return {stage: busy / wall for stage, busy in self.busy.items()}
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class KeyframeScheduler:
+    ''' decides which frames run the full lane detection
+
+    Keyframes go through the whole pipeline. In between, the lanes are tracked around the
+    averaged fit on a bird-eyes binary image subsampled by subsample, or with subsample=0 the
+    averaged fit is held as it is. The interval between keyframes doubles up to max_interval
+    while consecutive keyframes move the lanes by less than half of shift_tolerance pixels and
+    change their curvature by less than half of curve_tolerance (1/m), and drops back to
+    min_interval when either tolerance is exceeded. An update which fails its sanity checks or
+    drifts beyond a tolerance forces a keyframe.
+    '''
+    def __init__(self, min_interval=1, max_interval=8, shift_tolerance=15, curve_tolerance=1e-3,
+                 subsample=2):
+        if min_interval < 1 or max_interval < min_interval:
+            raise Exception("Invalid keyframe intervals {} to {}.".format(min_interval,
+                                                                          max_interval))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.shift_tolerance = shift_tolerance
+        self.curve_tolerance = curve_tolerance
+        self.subsample = subsample
+        self.interval = min_interval
+        self.since_keyframe = 0
+        self.force = True
+        self.reference = None
+        self.reset()
+
+    def copy(self):
+        ''' returns a scheduler with the same settings and no state '''
+        return KeyframeScheduler(self.min_interval, self.max_interval, self.shift_tolerance,
+                                 self.curve_tolerance, self.subsample)
+
+    def reset(self):
+        ''' clears the counters, the schedule itself is kept '''
+        self.frames = 0
+        self.keyframes = 0
+        self.forced = 0
+
+    def is_keyframe(self):
+        return self.force or self.since_keyframe + 1 >= self.interval
+
+    @staticmethod
+    def lane_state(tracker, height):
+        ''' returns lane x at the middle and bottom row of both averaged fits and the
+            curvature (1/m) of both lines, the far end of the fits jitters too much to tell '''
+        ploty = np.array([height // 2, height - 1])
+        return (np.concatenate((np.polyval(tracker.left_line.get_average_poly_fit(), ploty),
+                                np.polyval(tracker.right_line.get_average_poly_fit(), ploty))),
+                1 / np.maximum((tracker.left_line.get_average_curve(),
+                                tracker.right_line.get_average_curve()), 1e-6))
+
+    def change(self, state):
+        ''' returns the largest lane shift and curvature change against the last keyframe '''
+        if self.reference is None:
+            return np.inf, np.inf
+        return (np.abs(state[0] - self.reference[0]).max(),
+                np.abs(state[1] - self.reference[1]).max())
+
+    def keyframe_done(self, tracker, height):
+        ''' adapts the interval to the lane change since the last keyframe '''
+        state = self.lane_state(tracker, height)
+        shift, curve = self.change(state)
+        if shift <= self.shift_tolerance / 2 and curve <= self.curve_tolerance / 2:
+            self.interval = min(self.interval * 2, self.max_interval)
+        elif shift > self.shift_tolerance or curve > self.curve_tolerance:
+            self.interval = self.min_interval
+        self.reference = state
+        self.since_keyframe = 0
+        self.force = False
+        self.frames += 1
+        self.keyframes += 1
+
+    def update_done(self, tracker, height):
+        ''' forces the next frame to be a keyframe when the lanes drifted beyond a tolerance '''
+        shift, curve = self.change(self.lane_state(tracker, height))
+        if shift > self.shift_tolerance or curve > self.curve_tolerance:
+            self.force = True
+        self.since_keyframe += 1
+        self.frames += 1
+
+    def update_failed(self):
+        ''' the current frame is detected again as a keyframe '''
+        self.force = True
+        self.forced += 1
+
+    def extend(self, scheduler):
+        ''' adds the counters of another scheduler, e.g. of the next video segment '''
+        self.frames += scheduler.frames
+        self.keyframes += scheduler.keyframes
+        self.forced += scheduler.forced
+
+    def report(self):
+        return 'Keyframes: {} of {} frames ({:.0%} detection rate), {} forced by failed ' \
+               'updates'.format(self.keyframes, self.frames,
+                                self.keyframes / self.frames if self.frames else 0, self.forced)
@@ -1,103 +1,215 @@
 import numpy as np
 import cv2
+from utils.binary_image import get_buffer
+from utils.profiler import StageTimer
+
+
+def lane_moments(x, y):
+    ''' returns the sums needed for a 2nd order least squares fit of x over y:
+        sum(y^k) for k = 0..4, sum(x * y^k) for k = 0..2 and sum(x^2) '''
+    x = np.asarray(x, np.float64)
+    y = np.asarray(y, np.float64)
+    y2 = y * y
+    return np.array([len(y), y.sum(), y2.sum(), np.dot(y2, y), np.dot(y2, y2),
+                     x.sum(), np.dot(x, y), np.dot(x, y2), np.dot(x, x)])
+
+
+def fit_moments(moments):
+    ''' solves the normal equations of summed lane_moments, returns the fit as
+        [a, b, c] of a*y^2 + b*y + c like np.polyfit and the sum of squared residuals '''
+    sum_y = moments[:5]
+    normal = np.array([[sum_y[4], sum_y[3], sum_y[2]],
+                       [sum_y[3], sum_y[2], sum_y[1]],
+                       [sum_y[2], sum_y[1], sum_y[0]]])
+    rhs = moments[[7, 6, 5]]
+    # scale the columns to y in [0, 1] so the normal equations stay well conditioned
+    y_max = max(np.sqrt(sum_y[2] / max(sum_y[0], 1)), 1.0)
+    scale = np.array([1 / y_max ** 2, 1 / y_max, 1])
+    fit = np.linalg.lstsq(normal * scale * scale[:, None], rhs * scale, rcond=None)[0] * scale
+    residual = moments[8] - 2 * np.dot(fit, rhs) + np.dot(fit, np.dot(normal, fit))
+    return fit, max(residual, 0)
+
+
+def scale_poly_fit(poly_fit, ym_per_pix, xm_per_pix):
+    ''' converts a pixel space fit of x over y to world space '''
+    return np.array([poly_fit[0] * xm_per_pix / ym_per_pix ** 2,
+                     poly_fit[1] * xm_per_pix / ym_per_pix,
+                     poly_fit[2] * xm_per_pix])
+
+
+def curvature_radius(poly_fit, y_eval, ym_per_pix, xm_per_pix):
+    ''' returns the radius of curvature in metres of a pixel space fit at y_eval metres '''
+    fit_cr = scale_poly_fit(poly_fit, ym_per_pix, xm_per_pix)
+    first_derivative = 2 * fit_cr[0] * y_eval + fit_cr[1]
+    second_derivative = 2 * fit_cr[0]
+    return ((1 + first_derivative ** 2) ** 1.5) / np.absolute(second_derivative)
+
+
+class History:
+    ''' fixed size ring buffer of the last values added '''
+    def __init__(self, size, shape=(), dtype=np.float64):
+        self.values = np.zeros((size,) + shape, dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, len(self.values))
+
+    def append(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def last(self, index=0):
+        ''' returns the value added index steps before the most recent one '''
+        if index >= len(self):
+            raise IndexError('history has only {} values'.format(len(self)))
+        return self.values[(self.count - 1 - index) % len(self.values)]
+
+    def average(self):
+        return np.average(self.values[:len(self)], axis=0)
 
 
 class Line:
     ''' keep track of detected lines '''
-    average_count = 5
-    def __init__(self):
-        self.poly_fit = []
-        self.lane_ind = []
-        self.lane_start = []
-        self.lane_x = []
-        self.lane_y = []
-        self.curve = []
+    blend_weights = (4, 2, 1)
+
+    def __init__(self, average_count=5):
+        self.average_count = average_count
+        self.poly_fit = History(average_count, (3,))
+        self.lane_ind = History(average_count, dtype=object)
+        self.lane_start = History(average_count, dtype=np.int64)
+        self.lane_moments = History(len(Line.blend_weights), (9,))
+        self.curve = History(average_count)
 
     def add_poly_fit(self, poly_fit):
         self.poly_fit.append(poly_fit)
-        if len(self.poly_fit) > Line.average_count:
-            del self.poly_fit[0]
 
     def get_last_poly_fit(self):
-        return self.poly_fit[-1]
+        return self.poly_fit.last()
 
     def get_average_poly_fit(self):
-        return np.average(self.poly_fit, axis=0)
+        return self.poly_fit.average()
 
     def add_lane_ind(self, lane_ind):
         self.lane_ind.append(lane_ind)
-        if len(self.lane_ind) > Line.average_count:
-            del self.lane_ind[0]
 
     def get_last_lane_ind(self):
-        return self.lane_ind[-1]
+        return self.lane_ind.last()
 
-    def add_lane_points(self, x, y):
-        if x is not None and y is not None:
-            self.lane_x.append(x)
-            self.lane_y.append(y)
-        else:
-            self.lane_x.append([])
-            self.lane_y.append([])
+    def add_lane_points(self, x, y, moments=None):
+        ''' keeps the fit sums of a frame's lane pixels, the pixels themselves are not stored '''
+        if moments is None:
+            moments = lane_moments(x if x is not None else [], y if y is not None else [])
+        self.lane_moments.append(moments)
 
     def get_lane_points_poly_fit(self, ym_per_pix=1, xm_per_pix=1):
-        if Line.average_count == 1 or len(self.lane_x) < 3 or len(self.lane_y) < 3:
-            return np.polyfit(self.lane_y[-1] * ym_per_pix, self.lane_x[-1] * xm_per_pix, 2)    
+        ''' fits the last frame, or the last three frames weighted 4:2:1 once available '''
+        if self.average_count == 1 or len(self.lane_moments) < len(Line.blend_weights):
+            moments = self.lane_moments.last()
         else:
-            lane_y = np.concatenate((np.repeat(self.lane_y[-1], 4),
-                                     np.repeat(self.lane_y[-2], 2),
-                                     self.lane_y[-3]))
-            lane_x = np.concatenate((np.repeat(self.lane_x[-1], 4),
-                                     np.repeat(self.lane_x[-2], 2),
-                                     self.lane_x[-3]))
-            return np.polyfit(lane_y * ym_per_pix, lane_x * xm_per_pix, 2)    
+            moments = sum(weight * self.lane_moments.last(index)
+                          for index, weight in enumerate(Line.blend_weights))
+        poly_fit = fit_moments(moments)[0]
+        if ym_per_pix != 1 or xm_per_pix != 1:
+            poly_fit = scale_poly_fit(poly_fit, ym_per_pix, xm_per_pix)
+        return poly_fit
 
     def add_lane_start(self, lane_start):
         self.lane_start.append(lane_start)
-        if len(self.lane_start) > Line.average_count:
-            del self.lane_start[0]
 
     def get_last_lane_start(self):
-        return self.lane_start[-1]
+        return self.lane_start.last()
 
     def get_lane_start(self):
-        return self.lane_start[-1]
+        return self.lane_start.last()
         # if len(self.lane_start) == 1:
         #    return self.lane_start[0]
         # return (self.lane_start[-1] + self.lane_start[-2]) / 2.0
 
     def get_average_lane_start(self):
-        return np.average(self.lane_start, axis=0)
+        return self.lane_start.average()
 
     def add_curve(self, cr):
         self.curve.append(cr)
-        if (len(self.curve)) > Line.average_count:
-            del self.curve[0]
-    
+
     def get_average_curve(self):
-        return np.average(self.curve, axis=0)
+        return self.curve.average()
 
     def get_last_curve(self):
-        return self.curve[-1]
+        return self.curve.last()
+
+
+class LaneTracker:
+    ''' owns the state of one video stream: line histories, calibration, reusable buffers,
+        counters, stage timer and keyframe scheduler, so several streams can be tracked in one
+        process '''
+    def __init__(self, cam_cal=None, average_count=5, record=False, profile=False,
+                 scheduler=None):
+        self.cam_cal = cam_cal
+        self.left_line = Line(average_count)
+        self.right_line = Line(average_count)
+        self.buffers = {}
+        # the subsampled updates between keyframes have their own buffer sizes
+        self.update_buffers = {}
+        self.search_paths = {'track': 0, 'window': 0, 'hold': 0}
+        self.debug_frame_number = 0
+        self.records = [] if record else None
+        self.timer = StageTimer(profile)
+        self.scheduler = scheduler
+
+    def add_record(self, finder):
+        ''' keeps the averaged fits and lane position of a frame when recording is enabled '''
+        if self.records is not None:
+            self.records.append(np.concatenate((self.left_line.get_average_poly_fit(),
+                                                self.right_line.get_average_poly_fit(),
+                                                [finder.distance_from_center])))
+
+    def get_buffer(self, name, shape, dtype):
+        ''' returns a reusable output buffer, reallocated only when shape or dtype changes '''
+        return get_buffer(self.buffers, name, shape, dtype)
+
+
+INFO_FONT = cv2.FONT_HERSHEY_SIMPLEX
+INFO_LABELS = (('Left Curve: ', 50), ('Right Curve: ', 100), ('Distance from center ', 150))
+
 
 class LaneFinder:
-    ''' Finds lanes from perspective image '''
-    right_line = Line()
-    left_line = Line()
-
-    def __init__(self, image, cache=False):
-        if not cache:
-            Line.average_count = 1
-            LaneFinder.right_line.average_count = 1
-            LaneFinder.left_line.average_count = 1
+    ''' Finds lanes from perspective image
+
+    Line histories come from tracker, without one cache=True shares default_tracker and
+    cache=False uses a fresh single frame tracker. histogram and lane_starts may be passed in
+    when they were computed for a whole batch of images. A bird-eyes image subsampled by an
+    integer scale is searched in full resolution coordinates, so its fits, lane starts and
+    curvature join the same line histories. Window widths, margins and residuals are given in
+    full resolution pixels and pixel count thresholds in full resolution pixels as well,
+    each subsampled pixel standing for scale ** 2 of them.
+    '''
+    default_tracker = LaneTracker()
+    info_layout = None
+
+    def __init__(self, image, cache=False, tracker=None, histogram=None, lane_starts=None,
+                 scale=1):
+        if tracker is None:
+            tracker = LaneFinder.default_tracker if cache else LaneTracker(average_count=1)
+        self.tracker = tracker
+        self.left_line = tracker.left_line
+        self.right_line = tracker.right_line
         self.image = image
+        self.scale = scale
+        self.height = image.shape[0] * scale
+        self.width = image.shape[1] * scale
         if len(self.image.shape) != 2:
             raise Exception("Invalid image channels, expected 1 but {} provided.".\
                             format(len(self.image.shape)))
-        self.histogram = np.sum(image[image.shape[0]//2:, :], axis=0)
-        image_midpoint = self.histogram.shape[0]//2
-        self.left_lane_start = np.argmax(self.histogram[:image_midpoint])
-        self.right_lane_start = np.argmax(self.histogram[image_midpoint:]) + image_midpoint
+        if histogram is None:
+            histogram = np.sum(image[image.shape[0]//2:, :], axis=0)
+        self.histogram = histogram
+        if lane_starts is None:
+            image_midpoint = self.histogram.shape[0]//2
+            lane_starts = (np.argmax(self.histogram[:image_midpoint]),
+                           np.argmax(self.histogram[image_midpoint:]) + image_midpoint)
+            if scale != 1:
+                lane_starts = tuple(start * scale + scale // 2 for start in lane_starts)
+        self.left_lane_start, self.right_lane_start = lane_starts
         self.left_fit = None
         self.right_fit = None
         self.left_lane_inds = None
@@ -107,60 +219,155 @@ class LaneFinder:
         self.ym_per_pix = 30/720 # meters per pixel in y dimension
         self.xm_per_pix = 3.7/700 # meters per pixel in x dimension
         self.distance_from_center = ((self.left_lane_start + self.right_lane_start) / 2 -
-                                     self.image.shape[1] / 2)
+                                     self.width / 2)
         self.left_windows = []
         self.right_windows = []
+        self.search_path = None
+        self.nonzero_x = None
+        self.nonzero_y = None
+
+    def find_lanes(self, n_windows=9, window_width=100, min_pixel=50, track=False, margin=100,
+                   track_min_pixel=500, max_residual=40, lane_width=(3.0, 4.5)):
+        ''' tracks lanes around the previous fit when track is set and the lines have a history,
+            falls back to slide_window when tracking fails its sanity checks '''
+        if track and len(self.left_line.poly_fit) and len(self.right_line.poly_fit):
+            if self.track_lanes(margin, track_min_pixel, max_residual, lane_width):
+                return self.search_path
+        self.slide_window(n_windows, window_width, min_pixel)
+        return self.search_path
+
+    def track_lanes(self, margin=100, min_pixel=500, max_residual=40, lane_width=(3.0, 4.5)):
+        ''' Searches only within margin around the previous average fit of each line, the lines
+            are updated and True returned only when the pixel count, fit residual and lane width
+            checks pass '''
+        nonzero_x, nonzero_y = self.get_nonzero()
+
+        lane_inds = []
+        fits = []
+        moments = []
+        for line in (self.left_line, self.right_line):
+            previous_x = np.polyval(line.get_average_poly_fit(), nonzero_y)
+            inds = (np.absolute(nonzero_x - previous_x) < margin).nonzero()[0]
+            if len(inds) * self.scale ** 2 < min_pixel:
+                return False
+            line_moments = lane_moments(nonzero_x[inds], nonzero_y[inds])
+            fit, residual = fit_moments(line_moments)
+            if np.sqrt(residual / len(inds)) > max_residual:
+                return False
+            lane_inds.append(inds)
+            fits.append(fit)
+            moments.append(line_moments)
+
+        ploty = np.array([0, self.height // 2, self.height - 1])
+        widths = (np.polyval(fits[1], ploty) - np.polyval(fits[0], ploty)) * self.xm_per_pix
+        if np.any(widths < lane_width[0]) or np.any(widths > lane_width[1]):
+            return False
+
+        # lane starts and distance from center follow the tracked fits at the bottom row
+        self.left_lane_start = int(np.polyval(fits[0], self.height - 1))
+        self.right_lane_start = int(np.polyval(fits[1], self.height - 1))
+        self.distance_from_center = ((self.left_lane_start + self.right_lane_start) / 2 -
+                                     self.width / 2)
+        self.left_line.add_lane_start(self.left_lane_start)
+        self.right_line.add_lane_start(self.right_lane_start)
+        self.left_lane_inds, self.right_lane_inds = lane_inds
+        self._update_lines(nonzero_x, nonzero_y, moments)
+        self.search_path = 'track'
+        return True
+
+    def hold_lanes(self):
+        ''' keeps the line histories unchanged, lane starts and distance from center are those
+            of the last frame searched '''
+        self.left_lane_start = self.left_line.get_last_lane_start()
+        self.right_lane_start = self.right_line.get_last_lane_start()
+        self.distance_from_center = ((self.left_lane_start + self.right_lane_start) / 2 -
+                                     self.width / 2)
+        self.search_path = 'hold'
+        return self.search_path
+
+    def get_nonzero(self):
+        ''' returns x and y of the lit pixels in full resolution, computed once per image '''
+        if self.nonzero_x is None:
+            self.nonzero_y, self.nonzero_x = self.image.nonzero()
+            if self.scale != 1:
+                self.nonzero_x = self.nonzero_x * self.scale + self.scale // 2
+                self.nonzero_y = self.nonzero_y * self.scale + self.scale // 2
+        return self.nonzero_x, self.nonzero_y
+
+    def _index_bands(self, n_windows, window_height):
+        ''' buckets lit pixels by window band, each band sorted by x with prefix sums of x '''
+        nonzero_x, nonzero_y = self.get_nonzero()
+        # nonzero() is row major, so every band is a contiguous run of pixels
+        bounds = [self.height - window * window_height for window in range(n_windows + 1)]
+        bounds = np.searchsorted(nonzero_y, bounds)
+        bands = []
+        for window in range(n_windows):
+            start, end = bounds[window + 1], bounds[window]
+            order = start + np.argsort(nonzero_x[start:end], kind='stable')
+            band_x = nonzero_x[order]
+            cumsum_x = np.zeros(len(band_x) + 1, np.int64)
+            np.cumsum(band_x, out=cumsum_x[1:])
+            bands.append((order, band_x, cumsum_x))
+        return bands
+
+    @staticmethod
+    def _query_band(band, x_low, x_high):
+        ''' returns sorted pixel indices and the x sum of a band between x_low and x_high '''
+        order, band_x, cumsum_x = band
+        low, high = np.searchsorted(band_x, (x_low, x_high))
+        return np.sort(order[low:high]), cumsum_x[high] - cumsum_x[low]
 
     def slide_window(self, n_windows=9, window_width=100, min_pixel=50):
         ''' Slides a window on both lanes to find a polynomial fit '''
-        window_height = np.int(self.image.shape[0]/n_windows)
+        window_height = int(self.height/n_windows)
 
-        nonzero = self.image.nonzero()
-        nonzero_y = np.array(nonzero[0])
-        nonzero_x = np.array(nonzero[1])
+        nonzero_x, nonzero_y = self.get_nonzero()
+        bands = self._index_bands(n_windows, window_height)
 
-        LaneFinder.left_line.add_lane_start(self.left_lane_start)
-        LaneFinder.right_line.add_lane_start(self.right_lane_start)
+        self.left_line.add_lane_start(self.left_lane_start)
+        self.right_line.add_lane_start(self.right_lane_start)
 
-        left_current = LaneFinder.left_line.get_lane_start()
-        right_current = LaneFinder.right_line.get_lane_start()
+        left_current = self.left_line.get_lane_start()
+        right_current = self.right_line.get_lane_start()
 
         left_lane_inds = []
         right_lane_inds = []
         for window in range(n_windows):
             # Identify window boundaries in x and y (and right and left)
-            win_y_low = self.image.shape[0] - (window + 1) * window_height
-            win_y_high = self.image.shape[0] - window * window_height
+            win_y_low = self.height - (window + 1) * window_height
+            win_y_high = self.height - window * window_height
             win_xleft_low = left_current - window_width
             win_xleft_high = left_current + window_width
             win_xright_low = right_current - window_width
             win_xright_high = right_current + window_width
             # Identify the nonzero pixels in x and y within the window
-            good_left_inds = ((nonzero_y >= win_y_low) & (nonzero_y < win_y_high) &
-                              (nonzero_x >= win_xleft_low) & (nonzero_x < win_xleft_high)
-                             ).nonzero()[0]
-            good_right_inds = ((nonzero_y >= win_y_low) & (nonzero_y < win_y_high) &
-                               (nonzero_x >= win_xright_low) & (nonzero_x < win_xright_high)
-                              ).nonzero()[0]
+            good_left_inds, left_sum = self._query_band(bands[window], win_xleft_low,
+                                                        win_xleft_high)
+            good_right_inds, right_sum = self._query_band(bands[window], win_xright_low,
+                                                          win_xright_high)
             # Append these indices to the lists
             left_lane_inds.append(good_left_inds)
             right_lane_inds.append(good_right_inds)
             # If you found > minpix pixels, recenter next window on their mean position
-            if len(good_left_inds) > min_pixel:
-                left_current_ = np.mean(nonzero_x[good_left_inds])
-                left_current = np.int(np.average((left_current, left_current_), weights=(0.4, 0.6)))
-            if len(good_right_inds) > min_pixel:
-                right_current_ = np.mean(nonzero_x[good_right_inds])
-                right_current = np.int(np.average((right_current, right_current_), weights=(0.4, 0.6)))
+            if len(good_left_inds) * self.scale ** 2 > min_pixel:
+                left_current_ = left_sum / len(good_left_inds)
+                left_current = int(0.4 * left_current + 0.6 * left_current_)
+            if len(good_right_inds) * self.scale ** 2 > min_pixel:
+                right_current_ = right_sum / len(good_right_inds)
+                right_current = int(0.4 * right_current + 0.6 * right_current_)
             self.left_windows.append([(win_xleft_low, win_y_low), (win_xleft_high, win_y_high), len(good_left_inds)])
             self.right_windows.append([(win_xright_low, win_y_low), (win_xright_high, win_y_high), len(good_right_inds)])
 
         # Concatenate the arrays of indices
         self.left_lane_inds = np.concatenate(left_lane_inds)
         self.right_lane_inds = np.concatenate(right_lane_inds)
+        self._update_lines(nonzero_x, nonzero_y)
+        self.search_path = 'window'
 
-        LaneFinder.left_line.add_lane_ind(self.left_lane_inds)
-        LaneFinder.right_line.add_lane_ind(self.right_lane_inds)
+    def _update_lines(self, nonzero_x, nonzero_y, moments=(None, None)):
+        ''' adds the found lane pixels to both lines and updates fits and curvature '''
+        self.left_line.add_lane_ind(self.left_lane_inds)
+        self.right_line.add_lane_ind(self.right_lane_inds)
 
         # Extract left and right line pixel positions
         left_x = nonzero_x[self.left_lane_inds]
@@ -168,74 +375,80 @@ class LaneFinder:
         right_x = nonzero_x[self.right_lane_inds]
         right_y = nonzero_y[self.right_lane_inds]
 
-        LaneFinder.left_line.add_lane_points(left_x, left_y)
-        LaneFinder.right_line.add_lane_points(right_x, right_y)
+        self.left_line.add_lane_points(left_x, left_y, moments[0])
+        self.right_line.add_lane_points(right_x, right_y, moments[1])
 
         # Fit a second order polynomial to each lane
-        if len(left_x) > 0 and len(left_y) > 0:
-            self.left_fit = LaneFinder.left_line.get_lane_points_poly_fit()
+        if len(left_x) > 0:
+            self.left_fit = self.left_line.get_lane_points_poly_fit()
         else:
-            self.left_fit = LaneFinder.left_line.get_last_poly_fit()
-        if len(right_x) > 0 and len(right_y) > 0:
-            self.right_fit = LaneFinder.right_line.get_lane_points_poly_fit()
+            self.left_fit = self.left_line.get_last_poly_fit()
+        if len(right_x) > 0:
+            self.right_fit = self.right_line.get_lane_points_poly_fit()
         else:
-            self.right_fit = LaneFinder.right_line.get_last_poly_fit()
-
-        LaneFinder.left_line.add_poly_fit(self.left_fit)
-        LaneFinder.right_line.add_poly_fit(self.right_fit)
-
-        y_eval = self.image.shape[0] * self.ym_per_pix
-        if len(left_x) > 0 and len(left_y) > 0:
-            # Fit new polynomials to x,y in world space
-            left_fit_cr = LaneFinder.left_line.get_lane_points_poly_fit(self.ym_per_pix, self.xm_per_pix)
-            #np.polyfit(left_y * self.ym_per_pix, left_x * self.xm_per_pix, 2)
-            left_1st_derivative = 2 * left_fit_cr[0] * y_eval + left_fit_cr[1]
-            left_2nd_derivative = 2 * left_fit_cr[0]
-            self.left_curverad = (((1 + (left_1st_derivative) ** 2) ** 1.5) /
-                                  np.absolute(left_2nd_derivative))
+            self.right_fit = self.right_line.get_last_poly_fit()
+
+        self.left_line.add_poly_fit(self.left_fit)
+        self.right_line.add_poly_fit(self.right_fit)
+
+        y_eval = self.height * self.ym_per_pix
+        if len(left_x) > 0:
+            self.left_curverad = curvature_radius(self.left_fit, y_eval, self.ym_per_pix,
+                                                  self.xm_per_pix)
         else:
             self.left_curverad = 0
-        LaneFinder.left_line.add_curve(self.left_curverad)
-
-        if len(right_x) > 0 and len(right_y) > 0:
-            right_fit_cr = LaneFinder.right_line.get_lane_points_poly_fit(self.ym_per_pix, self.xm_per_pix)
-            right_1st_derivative = 2 * right_fit_cr[0] * y_eval + right_fit_cr[1]
-            right_2nd_derivative = 2 * right_fit_cr[0]
-            self.right_curverad = (((1 + (right_1st_derivative) ** 2) ** 1.5) /
-                                   np.absolute(right_2nd_derivative))
+        self.left_line.add_curve(self.left_curverad)
+
+        if len(right_x) > 0:
+            self.right_curverad = curvature_radius(self.right_fit, y_eval, self.ym_per_pix,
+                                                   self.xm_per_pix)
         else:
             self.right_curverad = 0
-        LaneFinder.right_line.add_curve(self.right_curverad)
+        self.right_line.add_curve(self.right_curverad)
+
+    def get_frame_fit(self, line):
+        ''' returns the fit and curvature of the lane pixels this frame found on line alone,
+            the fits drawn blend them with the previous frames; None when the frame held the
+            lanes or found no pixels on line '''
+        moments = line.lane_moments.last() if len(line.lane_moments) else None
+        if self.search_path in (None, 'hold') or moments is None or moments[0] == 0:
+            return None, None
+        fit = fit_moments(moments)[0]
+        return fit, curvature_radius(fit, self.height * self.ym_per_pix, self.ym_per_pix,
+                                     self.xm_per_pix)
+
+    def lane_polygon(self):
+        ''' returns the (2 * height, 2) outline of the lane between the averaged fits, down the
+            left line and back up the right one '''
+        ploty = np.linspace(0, self.height - 1, self.height)
+        left_fit = self.left_line.get_average_poly_fit()
+        right_fit = self.right_line.get_average_poly_fit()
+        left_fitx = left_fit[0] * ploty ** 2 + left_fit[1] * ploty + left_fit[2]
+        right_fitx = right_fit[0] * ploty ** 2 + right_fit[1] * ploty + right_fit[2]
+        return np.vstack((np.column_stack((left_fitx, ploty)),
+                          np.column_stack((right_fitx, ploty))[::-1]))
 
     def visualize(self, draw_on_image=True, draw_lane_pixels=True, draw_lane=True, draw_windows=True):
         ''' visualize founded lanes and windows on image '''
         #if self.left_fit is None or self.right_fit is None:
         #    return None
-        vis_img = np.dstack((self.image, self.image, self.image))
-        if not draw_on_image:
-            vis_img = np.zeros_like(vis_img)
-        ploty = np.linspace(0, self.image.shape[0] - 1, self.image.shape[0])
-
-        left_fit = LaneFinder.left_line.get_average_poly_fit()
-        right_fit = LaneFinder.right_line.get_average_poly_fit()
-
-        left_fitx = left_fit[0] * ploty ** 2 + left_fit[1] * ploty + left_fit[2]
-        right_fitx = right_fit[0] * ploty ** 2 + right_fit[1] * ploty + right_fit[2]
-
-        nonzero = self.image.nonzero()
-        nonzero_y = np.array(nonzero[0])
-        nonzero_x = np.array(nonzero[1])
-
-        pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
-        pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
-        pts = np.hstack((pts_left, pts_right))
+        if draw_on_image:
+            image = self.image
+            if self.scale != 1:
+                image = cv2.resize(image, (self.width, self.height),
+                                   interpolation=cv2.INTER_NEAREST)
+            vis_img = np.dstack((image, image, image))
+        else:
+            vis_img = np.zeros((self.height, self.width, 3), self.image.dtype)
+        nonzero_x, nonzero_y = self.get_nonzero()
+        pts = self.lane_polygon()[None]
 
         if draw_lane:
             cv2.fillPoly(vis_img, np.int_([pts]), (0, 255, 0))
 
         if draw_lane_pixels:
-            left_lane_inds = LaneFinder.left_line.get_last_lane_ind()
-            right_lane_inds = LaneFinder.right_line.get_last_lane_ind()
+            left_lane_inds = self.left_line.get_last_lane_ind()
+            right_lane_inds = self.right_line.get_last_lane_ind()
             vis_img[nonzero_y[left_lane_inds], nonzero_x[left_lane_inds]] = [255, 0, 0]
             vis_img[nonzero_y[right_lane_inds], nonzero_x[right_lane_inds]] = [0, 0, 255]
 
@@ -250,21 +463,63 @@ class LaneFinder:
                             cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 1)
         return vis_img
 
+    @staticmethod
+    def get_info_layout():
+        ''' returns the static labels of draw_info as (label, alpha patch, patch box, value
+            origin), rendered once and composited on every frame '''
+        layout = LaneFinder.info_layout
+        if layout is None:
+            layout = []
+            pad = 4
+            for label, y in INFO_LABELS:
+                (width, height), baseline = cv2.getTextSize(label, INFO_FONT, 1, 2)
+                canvas = np.zeros((height + baseline + 2 * pad, width + 2 * pad), np.uint8)
+                cv2.putText(canvas, label, (pad, height + pad), INFO_FONT, 1, 255, 2)
+                rows, cols = canvas.nonzero()
+                y0, y1, x0, x1 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+                box = (20 - pad + x0, y - height - pad + y0, 20 - pad + x1, y - height - pad + y1)
+                # the advance of the label, text size also counts the stroke of the last glyph
+                advance = (cv2.getTextSize(label + '0', INFO_FONT, 1, 2)[0][0] -
+                           cv2.getTextSize('0', INFO_FONT, 1, 2)[0][0])
+                layout.append((label, cv2.merge([canvas[y0:y1, x0:x1]] * 3), box,
+                               (20 + advance, y)))
+            LaneFinder.info_layout = layout
+        return layout
+
     def draw_info(self, image):
         ''' draw curve information on input image'''
-        text = "Left Curve: {:6.2f}m".format(LaneFinder.left_line.get_average_curve())
-        cv2.putText(image, text, (20, 50),
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        text = "Right Curve: {:6.2f}m".format(LaneFinder.right_line.get_average_curve())
-        cv2.putText(image, text, (20, 100),
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        text = "Distance from center {:4.2f}m to the {}"
         if self.distance_from_center < 0:
-            text = text.format(-self.distance_from_center * self.xm_per_pix, 'left')
+            distance = "{:4.2f}m to the left".format(-self.distance_from_center * self.xm_per_pix)
         elif self.distance_from_center == 0:
-            text = "Distance from center 0m"
+            distance = "0m"
         else:
-            text = text.format(self.distance_from_center * self.xm_per_pix, 'right')
-        cv2.putText(image, text, (20, 150),
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+            distance = "{:4.2f}m to the right".format(self.distance_from_center * self.xm_per_pix)
+        values = ("{:6.2f}m".format(self.left_line.get_average_curve()),
+                  "{:6.2f}m".format(self.right_line.get_average_curve()), distance)
+        for (label, alpha, box, origin), value in zip(self.get_info_layout(), values):
+            region = image[box[1]:box[3], box[0]:box[2]]
+            if region.shape != alpha.shape:
+                cv2.putText(image, label, (20, origin[1]), INFO_FONT, 1, (255, 255, 255), 2)
+            else:
+                # white text over the frame weighted by the antialiased label coverage
+                cv2.add(region, cv2.multiply(cv2.bitwise_not(region), alpha, scale=1 / 255.0),
+                        dst=region)
+            cv2.putText(image, value, origin, INFO_FONT, 1, (255, 255, 255), 2)
+        return image
+
+
+def blend_polygon(image, points, color=(0, 255, 0), alpha=0.3):
+    ''' adds alpha * color inside the polygon points, an (N, 2) float array, to image in place,
+        rasterizing and blending only within the bounding box of the polygon '''
+    x0, y0 = np.maximum(np.floor(points.min(axis=0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(points.max(axis=0)).astype(int) + 1,
+                        (image.shape[1], image.shape[0]))
+    if x1 <= x0 or y1 <= y0:
         return image
+    canvas = np.zeros((y1 - y0, x1 - x0, image.shape[2]), image.dtype)
+    # 4 fractional bits keep the sub-pixel position of the projected points
+    polygon = np.round((points - (x0, y0)) * 16).astype(np.int32)
+    cv2.fillPoly(canvas, [polygon], color, cv2.LINE_AA, 4)
+    region = image[y0:y1, x0:x1]
+    cv2.addWeighted(region, 1, canvas, alpha, 0, dst=region)
+    return image
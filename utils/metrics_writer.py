@@ -0,0 +1,133 @@
+import csv
+import zipfile
+import numpy as np
+
+
+def metrics_dtype(n_windows=9):
+    ''' returns the structured dtype of one frame's lane record '''
+    fields = [('frame', np.int64), ('time', np.float64), ('search_path', 'U6')]
+    fields += [('{}_fit_{}'.format(side, name), np.float64)
+               for side in ('left', 'right') for name in 'abc']
+    fields += [('left_curverad', np.float64), ('right_curverad', np.float64),
+               ('distance_from_center', np.float64),
+               ('left_pixels', np.int64), ('right_pixels', np.int64)]
+    fields += [('{}_window_{}'.format(side, window), np.int64)
+               for side in ('left', 'right') for window in range(n_windows)]
+    return np.dtype(fields)
+
+
+def lane_record(finder, frame, time, n_windows=9):
+    ''' returns the lane record of a frame as a tuple of metrics_dtype fields
+
+    Fits and curvature are fitted to the lane pixels of the frame alone, not to the blend of
+    the last frames the drawn lanes use, and NaN when the frame held the previous lanes or
+    found no pixels on the line. Distance from center is in metres. Pixel and window counts are
+    full resolution counts, the subsampled counts of a work scale above 1 are multiplied by the
+    pixels each one stands for. Window pixel counts are -1 unless the frame was searched with
+    sliding windows.
+    '''
+    fits = []
+    curverads = []
+    for line in (finder.left_line, finder.right_line):
+        fit, curverad = finder.get_frame_fit(line)
+        fits.extend(fit if fit is not None else (np.nan,) * 3)
+        curverads.append(curverad if curverad is not None else np.nan)
+    area = finder.scale ** 2
+    pixels = [len(inds) * area if inds is not None else 0
+              for inds in (finder.left_lane_inds, finder.right_lane_inds)]
+    windows = []
+    for side_windows in (finder.left_windows, finder.right_windows):
+        counts = [window[2] * area for window in side_windows[:n_windows]]
+        windows.extend(counts + [-1] * (n_windows - len(counts)))
+    return tuple([frame, time, finder.search_path] + fits + curverads +
+                 [finder.distance_from_center * finder.xm_per_pix] + pixels + windows)
+
+
+class MetricsWriter:
+    ''' writes per frame lane records to a .csv, .npz or .parquet file
+
+    Records are collected in a chunk_size buffer and written out chunk by chunk, so hours of
+    video never hold more than one chunk in memory. An NPZ file holds one structured array per
+    chunk, read concatenates them. Parquet output needs pyarrow.
+    '''
+    FORMATS = ('.csv', '.npz', '.parquet')
+
+    def __init__(self, filename, chunk_size=1000, n_windows=9):
+        self.format = next((ext for ext in MetricsWriter.FORMATS if filename.endswith(ext)), None)
+        if self.format is None:
+            raise Exception("Invalid metrics file {}, expected one of {}.".format(
+                filename, ', '.join(MetricsWriter.FORMATS)))
+        self.filename = filename
+        self.dtype = metrics_dtype(n_windows)
+        self.buffer = np.empty(chunk_size, self.dtype)
+        self.pending = 0
+        self.count = 0
+        self.chunks = 0
+        self.output = None
+        self.writer = None
+        if self.format == '.csv':
+            self.output = open(filename, 'w', newline='')
+            self.writer = csv.writer(self.output)
+            self.writer.writerow(self.dtype.names)
+        elif self.format == '.npz':
+            self.output = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            try:
+                import pyarrow
+            except ImportError:
+                raise Exception("Parquet metrics need pyarrow, write .csv or .npz instead.")
+
+    def add(self, record):
+        ''' appends a lane_record tuple, writing the chunk once it is full '''
+        self.buffer[self.pending] = record
+        self.pending += 1
+        self.count += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        ''' writes the records collected since the last chunk '''
+        if not self.pending:
+            return
+        chunk = self.buffer[:self.pending]
+        if self.format == '.csv':
+            self.writer.writerows(chunk.tolist())
+            self.output.flush()
+        elif self.format == '.npz':
+            with self.output.open('chunk_{:06d}.npy'.format(self.chunks), 'w',
+                                  force_zip64=True) as output:
+                np.lib.format.write_array(output, chunk, allow_pickle=False)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.Table.from_arrays([pyarrow.array(chunk[name])
+                                               for name in self.dtype.names],
+                                              names=list(self.dtype.names))
+            if self.writer is None:
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+            self.writer.write_table(table)
+        self.chunks += 1
+        self.pending = 0
+
+    def close(self):
+        ''' writes the last chunk and closes the file '''
+        self.flush()
+        if self.format == '.parquet':
+            if self.writer is not None:
+                self.writer.close()
+        else:
+            self.output.close()
+
+    @staticmethod
+    def read(filename):
+        ''' returns all records of a metrics file as one structured array '''
+        if filename.endswith('.npz'):
+            with np.load(filename) as data:
+                return np.concatenate([data[name] for name in sorted(data.files)])
+        if filename.endswith('.csv'):
+            return np.genfromtxt(filename, delimiter=',', names=True, dtype=None,
+                                 encoding='utf-8')
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(filename)
+        return np.rec.fromarrays([column.to_numpy() for column in table.columns],
+                                 names=table.column_names)
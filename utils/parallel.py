@@ -0,0 +1,43 @@
+import os
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+
+def image_filenames(input_dir):
+    ''' returns the sorted image filenames of input_dir '''
+    return [filename for filename in sorted(os.listdir(input_dir))
+            if filename.endswith('.jpg') or filename.endswith('.png')]
+
+
+def run_jobs(function, items, jobs=1, max_in_flight=None):
+    ''' yields (item, result, error) for every item in input order
+
+    function(item) runs in a pool of jobs processes, or inline when jobs is one. At most
+    max_in_flight items (twice the number of jobs by default) are submitted and not yet
+    yielded, which bounds the results held in memory. An exception raised for one item is
+    yielded as its error and does not stop the others.
+    '''
+    if jobs <= 1:
+        for item in items:
+            try:
+                yield item, function(item), None
+            except Exception as error:
+                yield item, None, error
+        return
+    if not max_in_flight:
+        max_in_flight = 2 * jobs
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, executor.submit(function, item)))
+            while len(pending) >= max_in_flight:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+
+
+def _collect(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as error:
+        return item, None, error
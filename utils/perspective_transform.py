@@ -2,30 +2,134 @@ import cv2
 import numpy as np
 
 class PerspectiveTransform:
-    ''' transforms the image to a bird-eyes view '''
-    def __init__(self, image):
+    ''' transforms the image to a bird-eyes view
+
+    When cam_cal is given the image is a raw (distorted) frame, get undistorts and warps it with
+    one composite remap and get_inverse maps a bird-eyes image back onto the raw frame.
+    '''
+    geometry_cache = {}
+
+    def __init__(self, image, cam_cal=None, use_maps=False):
         self.image = image
+        self.cam_cal = cam_cal
+        self.use_maps = use_maps
         self.img_size = (image.shape[1], image.shape[0])
-        self.src = np.float32(
-            [[(self.img_size[0] / 2) - 65, self.img_size[1] / 2 + 100],
-             [((self.img_size[0] / 6) - 10), self.img_size[1]],
-             [(self.img_size[0] * 5 / 6) + 60, self.img_size[1]],
-             [(self.img_size[0] / 2 + 65), self.img_size[1] / 2 + 100]])
-        self.dst = np.float32(
-            [[(self.img_size[0] / 5), -20],
-             [(self.img_size[0] / 5), self.img_size[1]],
-             [(self.img_size[0] * 4 / 5), self.img_size[1]],
-             [(self.img_size[0] * 4 / 5), -20]])
-        self.M = cv2.getPerspectiveTransform(self.src, self.dst)
-        self.Minv = cv2.getPerspectiveTransform(self.dst, self.src)
-
-    def get(self):
-        ''' returns perspective transformed image using transformation matrix '''
-        return cv2.warpPerspective(self.image, self.M, self.img_size, flags=cv2.INTER_LINEAR)
-
-    def get_inverse(self):
-        ''' returns perspective transformed image using inverse transformation matrix '''
-        return cv2.warpPerspective(self.image, self.Minv, self.img_size, flags=cv2.INTER_LINEAR)
+        self.geometry = PerspectiveTransform.get_geometry(self.img_size)
+        self.src = self.geometry['src']
+        self.dst = self.geometry['dst']
+        self.M = self.geometry['M']
+        self.Minv = self.geometry['Minv']
+
+    @staticmethod
+    def get_geometry(img_size, scale=1):
+        ''' returns src, dst, M and Minv for img_size (width, height), computed once per size.
+            With an integer scale they are those of the full img_size warp in the pixels of
+            images subsampled by scale, see get_subsample_matrix. '''
+        if scale != 1:
+            geometry = PerspectiveTransform.geometry_cache.get((img_size, scale))
+            if geometry is None:
+                full = PerspectiveTransform.get_geometry(img_size)
+                subsample = PerspectiveTransform.get_subsample_matrix(scale)
+                src, dst = (cv2.perspectiveTransform(full[name].reshape(-1, 1, 2),
+                                                     subsample).reshape(-1, 2)
+                            for name in ('src', 'dst'))
+                M = subsample.dot(full['M']).dot(np.linalg.inv(subsample))
+                geometry = {'src': src, 'dst': dst, 'M': M, 'Minv': np.linalg.inv(M)}
+                PerspectiveTransform.geometry_cache[(img_size, scale)] = geometry
+            return geometry
+        geometry = PerspectiveTransform.geometry_cache.get(img_size)
+        if geometry is None:
+            src = np.float32(
+                [[(img_size[0] / 2) - 65, img_size[1] / 2 + 100],
+                 [((img_size[0] / 6) - 10), img_size[1]],
+                 [(img_size[0] * 5 / 6) + 60, img_size[1]],
+                 [(img_size[0] / 2 + 65), img_size[1] / 2 + 100]])
+            dst = np.float32(
+                [[(img_size[0] / 5), -20],
+                 [(img_size[0] / 5), img_size[1]],
+                 [(img_size[0] * 4 / 5), img_size[1]],
+                 [(img_size[0] * 4 / 5), -20]])
+            geometry = {'src': src, 'dst': dst,
+                        'M': cv2.getPerspectiveTransform(src, dst),
+                        'Minv': cv2.getPerspectiveTransform(dst, src)}
+            PerspectiveTransform.geometry_cache[img_size] = geometry
+        return geometry
+
+    @staticmethod
+    def get_subsample_matrix(scale):
+        ''' returns the matrix taking full resolution pixels to an image subsampled by an
+            integer scale, whose pixel x lies at x * scale + scale // 2 in full resolution
+            like the lane pixels of a subsampled LaneFinder '''
+        offset = -(scale // 2) / scale
+        return np.array([[1.0 / scale, 0, offset], [0, 1.0 / scale, offset], [0, 0, 1]])
+
+    def get_roi(self):
+        ''' returns the (x0, y0, x1, y1) bounding box of input pixels read by get '''
+        roi = self.geometry.get('roi')
+        if roi is None:
+            width, height = self.img_size
+            corners = np.float32([[[0, 0]], [[width, 0]], [[0, height]], [[width, height]]])
+            corners = cv2.perspectiveTransform(corners, self.Minv).reshape(-1, 2)
+            # one extra pixel on each side for bilinear interpolation
+            x0, y0 = np.floor(corners.min(axis=0)).astype(int) - 1
+            x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + 2
+            roi = (max(int(x0), 0), max(int(y0), 0), min(int(x1), width), min(int(y1), height))
+            self.geometry['roi'] = roi
+        return roi
+
+    def _get_maps(self, name, matrix):
+        ''' returns cached fixed-point remap tables equivalent to warping by matrix '''
+        maps = self.geometry.get(name)
+        if maps is None:
+            grid = np.mgrid[0:self.img_size[1], 0:self.img_size[0]].astype(np.float32)
+            points = np.dstack((grid[1], grid[0])).reshape(-1, 1, 2)
+            points = cv2.perspectiveTransform(points, np.linalg.inv(matrix))
+            points = points.reshape(self.img_size[1], self.img_size[0], 2)
+            maps = cv2.convertMaps(points, None, cv2.CV_16SC2)
+            self.geometry[name] = maps
+        return maps
+
+    def get(self, output=None):
+        ''' returns perspective transformed image using transformation matrix,
+            written into output when a buffer of the right shape is given '''
+        if self.cam_cal is not None:
+            map1, map2 = self.cam_cal.get_warp_maps(self.img_size, self.M)
+            return cv2.remap(self.image, map1, map2, cv2.INTER_LINEAR, dst=output)
+        if self.use_maps:
+            map1, map2 = self._get_maps('maps', self.M)
+            return cv2.remap(self.image, map1, map2, cv2.INTER_LINEAR, dst=output)
+        return cv2.warpPerspective(self.image, self.M, self.img_size, dst=output,
+                                   flags=cv2.INTER_LINEAR)
+
+    def get_inverse(self, output=None):
+        ''' returns perspective transformed image using inverse transformation matrix,
+            written into output when a buffer of the right shape is given '''
+        if self.cam_cal is not None:
+            map1, map2 = self.cam_cal.get_unwarp_maps(self.img_size, self.M)
+            return cv2.remap(self.image, map1, map2, cv2.INTER_LINEAR, dst=output)
+        if self.use_maps:
+            map1, map2 = self._get_maps('inverse_maps', self.Minv)
+            return cv2.remap(self.image, map1, map2, cv2.INTER_LINEAR, dst=output)
+        return cv2.warpPerspective(self.image, self.Minv, self.img_size, dst=output,
+                                   flags=cv2.INTER_LINEAR)
+
+    def get_inverse_points(self, points, max_step=8):
+        ''' maps the bird-eyes polygon points, an (N, 2) array, back onto the input image like
+            get_inverse. With cam_cal the points are distorted too, after splitting polygon
+            edges longer than max_step pixels, as straight edges bend in the raw frame. '''
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        if self.cam_cal is not None:
+            edges = np.roll(points, -1, axis=0) - points
+            steps = np.maximum(np.ceil(np.hypot(edges[:, 0], edges[:, 1]) / max_step), 1)
+            starts = np.repeat(np.arange(len(points)), steps.astype(int))
+            fractions = np.arange(len(starts)) - np.repeat(np.cumsum(steps) - steps,
+                                                           steps.astype(int))
+            points = points[starts] + edges[starts] * (fractions / steps[starts])[:, None]
+        points = cv2.perspectiveTransform(points.reshape(-1, 1, 2),
+                                          self.Minv.astype(np.float64)).reshape(-1, 2)
+        if self.cam_cal is not None:
+            points = self.cam_cal.distort_points(points)
+        return points
 
     def visualize(self):
         ''' visualize perspective transformation effect '''
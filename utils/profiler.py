@@ -0,0 +1,118 @@
+import csv
+import json
+import time
+from contextlib import nullcontext
+import numpy as np
+
+NULL_STAGE = nullcontext()
+
+
+class StageTimer:
+    ''' times named stages of every frame
+
+    Stages are timed with `with timer.stage(name):` between start_frame and end_frame, nested
+    start_frame calls belong to the outer frame. A disabled timer returns a shared no-op
+    context and keeps no records, so instrumented code costs next to nothing.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.stages = []
+        self.frame_number = 0
+        self.record = None
+        self.frame_start = None
+        self.depth = 0
+        self.outside = 0.0
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+        self.depth += 1
+        if self.depth == 1:
+            self.record = {}
+            self.outside = 0.0
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.depth -= 1
+        if self.depth == 0:
+            self.record['total'] = time.perf_counter() - self.frame_start + self.outside
+            self.record['frame'] = self.frame_number
+            self.records.append(self.record)
+            self.frame_number += 1
+            self.record = None
+
+    def stage(self, name):
+        ''' returns a context manager adding its run time to stage name of the current frame '''
+        if not self.enabled or self.record is None:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds, outside=False):
+        ''' adds seconds to stage name of the current frame, outside marks time spent before
+            the frame started, e.g. its share of work done for a whole batch, which then also
+            counts towards the frame total '''
+        if not self.enabled or self.record is None:
+            return
+        if outside:
+            self.outside += seconds
+        if name not in self.record:
+            self.record[name] = 0.0
+            if name not in self.stages:
+                self.stages.append(name)
+        self.record[name] += seconds
+
+    def reset(self, frame_number=0):
+        ''' drops the records, the next frame is numbered frame_number '''
+        self.records = []
+        self.frame_number = frame_number
+
+    def extend(self, timer):
+        ''' appends the records of another timer, e.g. of the next video segment '''
+        self.records.extend(timer.records)
+        for name in timer.stages:
+            if name not in self.stages:
+                self.stages.append(name)
+
+    def summary(self):
+        ''' returns stage name to (p50, p95, p99) milliseconds, total last '''
+        summary = {}
+        for name in self.stages + ['total']:
+            times = [record[name] for record in self.records if name in record]
+            if times:
+                summary[name] = tuple(np.percentile(np.array(times) * 1000, (50, 95, 99)))
+        return summary
+
+    def print_summary(self):
+        print('{:<16}{:>10}{:>10}{:>10}'.format('stage (ms)', 'p50', 'p95', 'p99'))
+        for name, percentiles in self.summary().items():
+            print('{:<16}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name, *percentiles))
+
+    def save(self, filename):
+        ''' writes the per frame records in seconds, as JSON when filename ends with .json
+            and as CSV otherwise '''
+        if filename.endswith('.json'):
+            with open(filename, 'w') as output:
+                json.dump(self.records, output, indent=1)
+            return
+        with open(filename, 'w', newline='') as output:
+            writer = csv.DictWriter(output, ['frame'] + self.stages + ['total'])
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,159 @@
+import sys
+import json
+import socket
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class CaptureSource:
+    ''' reads BGR frames from a cv2.VideoCapture source, a camera index, file or URL '''
+    def __init__(self, source):
+        self.capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+        if not self.capture.isOpened():
+            raise Exception("Can't open video source {}.".format(source))
+
+    def read(self):
+        ret, frame = self.capture.read()
+        return frame if ret else None
+
+    def close(self):
+        self.capture.release()
+
+
+class RawSource:
+    ''' reads raw BGR frames of img_size (width, height) from a binary stream, a named pipe,
+        a file or stdin when filename is '-' '''
+    def __init__(self, filename, img_size):
+        self.shape = (img_size[1], img_size[0], 3)
+        self.frame_bytes = img_size[0] * img_size[1] * 3
+        if filename == '-':
+            self.stream = sys.stdin.buffer
+        else:
+            self.stream = open(filename, 'rb')
+
+    def read(self):
+        data = self.stream.read(self.frame_bytes)
+        if data is None or len(data) < self.frame_bytes:
+            return None
+        return np.frombuffer(data, np.uint8).reshape(self.shape)
+
+    def close(self):
+        if self.stream is not sys.stdin.buffer:
+            self.stream.close()
+
+
+def open_result_sink(output):
+    ''' returns a text stream for lane results, stdout for '-' and a TCP connection for
+        tcp://host:port '''
+    if output == '-':
+        return sys.stdout
+    if output.startswith('tcp://'):
+        host, port = output[len('tcp://'):].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile('w')
+    return open(output, 'w')
+
+
+class StreamProcessor:
+    ''' finds lanes on a live frame source against a per frame latency budget
+
+    A reader thread keeps only the newest frame, a frame replaced before it was picked up is
+    dropped, and a frame older than budget_ms when processing would start is skipped as stale,
+    so a slow frame never builds up a backlog. source_fps paces reads from sources that are
+    not real time, e.g. a file standing in for a camera. Every processed frame is written as
+    one JSON line to sink.
+    '''
+    def __init__(self, source, processor, budget_ms=50, sink=None, source_fps=0):
+        self.source = source
+        self.processor = processor
+        self.budget = budget_ms / 1000.0
+        self.sink = sink
+        self.source_fps = source_fps
+        self.condition = threading.Condition()
+        self.latest = None
+        self.finished = False
+        self.stop = False
+        self.frames_read = 0
+        self.dropped = 0
+        self.stale = 0
+        self.late = 0
+        self.latencies = []
+
+    def _read(self):
+        start = time.perf_counter()
+        try:
+            while not self.stop:
+                if self.source_fps:
+                    delay = start + self.frames_read / self.source_fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                frame = self.source.read()
+                if frame is None:
+                    break
+                with self.condition:
+                    if self.latest is not None:
+                        self.dropped += 1
+                    self.latest = (self.frames_read, time.perf_counter(), frame)
+                    self.frames_read += 1
+                    self.condition.notify()
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify()
+
+    def result(self, frame_number, captured, finder, search_path):
+        ''' returns the lane result of a processed frame as a dict '''
+        return {'frame': frame_number,
+                'latency_ms': (time.perf_counter() - captured) * 1000,
+                'search_path': search_path,
+                'left_fit': finder.left_line.get_average_poly_fit().tolist(),
+                'right_fit': finder.right_line.get_average_poly_fit().tolist(),
+                'left_curverad': float(finder.left_line.get_average_curve()),
+                'right_curverad': float(finder.right_line.get_average_curve()),
+                'distance_from_center': float(finder.distance_from_center * finder.xm_per_pix)}
+
+    def run(self):
+        ''' processes frames until the source ends, returns the stream statistics '''
+        reader = threading.Thread(target=self._read, daemon=True)
+        timer = self.processor.tracker.timer
+        start = time.perf_counter()
+        reader.start()
+        try:
+            while True:
+                with self.condition:
+                    while self.latest is None and not self.finished:
+                        self.condition.wait()
+                    if self.latest is None:
+                        break
+                    frame_number, captured, frame = self.latest
+                    self.latest = None
+                if time.perf_counter() - captured > self.budget:
+                    self.stale += 1
+                    continue
+                timer.start_frame()
+                finder = self.processor.prepare_bgr(frame, undistort=False)[0]
+                search_path = self.processor.track_lanes(finder)
+                timer.end_frame()
+                result = self.result(frame_number, captured, finder, search_path)
+                if result['latency_ms'] > self.budget * 1000:
+                    self.late += 1
+                self.latencies.append(result['latency_ms'])
+                if self.sink is not None:
+                    self.sink.write(json.dumps(result) + '\n')
+                    self.sink.flush()
+        finally:
+            self.stop = True
+            if self.finished:
+                reader.join()
+        return self.stats(time.perf_counter() - start)
+
+    def stats(self, wall):
+        ''' returns fps, frame counts and end to end latency percentiles of the run '''
+        stats = {'frames_read': self.frames_read, 'processed': len(self.latencies),
+                 'dropped': self.dropped, 'stale': self.stale, 'late': self.late,
+                 'fps': len(self.latencies) / wall if wall > 0 else 0.0}
+        if self.latencies:
+            stats.update(zip(('p50_ms', 'p95_ms', 'p99_ms'),
+                             np.percentile(self.latencies, (50, 95, 99)).tolist()))
+        return stats
@@ -1,92 +1,524 @@
 import os
+import time
+import hashlib
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cv2
-from utils.camera_cal import CameraCalibration
-from utils.binary_image import BinaryImage
+import numpy as np
+from utils.camera_cal import CameraCalibration, CALIBRATION_VERSION, CHESSBOARD_SIZE
+from utils.binary_image import BinaryImage, get_buffer
 from utils.perspective_transform import PerspectiveTransform
-from utils.lane_finder import LaneFinder
+from utils.lane_finder import LaneFinder, LaneTracker, blend_polygon
+from utils.frame_pipeline import FramePipeline
+from utils.batch_processor import BatchProcessor
+from utils.metrics_writer import MetricsWriter, lane_record
+from utils.parallel import image_filenames
 
 
 class VideoProcessor:
-    ''' Process a video for finding lanes '''
-    cam_cal = None
-    debug_dir = None
-    debug_frame_number = 0
-    debug_frame_bypass = 10
+    ''' Process a video for finding lanes, per stream state is kept in its LaneTracker and
+        intermediate images of sampled frames go to debug_writer, a DebugWriter, when set.
+        overlay 'warp' draws the lane in a bird-eyes image warped back onto the frame,
+        'project' projects the lane outline onto the frame and blends only its bounding box.
+        warp_maps warps with cached fixed-point remap tables, faster than warpPerspective
+        but not bit exact, so a few lane pixels and the curvature may change.
+        An integer work_scale above 1 thresholds and searches frames subsampled by it, the
+        lanes are still found and drawn in full resolution coordinates. '''
+    OVERLAYS = ('warp', 'project')
 
-    @staticmethod
-    def init(input_video, output_video, camera_cal_directory, debug_dir=None):
-        ''' initialize static class members '''
-        VideoProcessor.input_video = input_video
-        VideoProcessor.output_video = output_video
-        VideoProcessor.cam_cal = VideoProcessor.calibrate_camera(camera_cal_directory)
-        VideoProcessor.debug_dir = debug_dir
-        VideoProcessor.debug_frame_number = 0
-        if debug_dir is not None:
-            os.makedirs(os.path.join(debug_dir, 'original'), exist_ok=True)
-            os.makedirs(os.path.join(debug_dir, 'undist'), exist_ok=True)
-            os.makedirs(os.path.join(debug_dir, 'binary'), exist_ok=True)
-            os.makedirs(os.path.join(debug_dir, 'perspective'), exist_ok=True)
-            os.makedirs(os.path.join(debug_dir, 'lanes'), exist_ok=True)
-            os.makedirs(os.path.join(debug_dir, 'final'), exist_ok=True)
+    def __init__(self, input_video, output_video, tracker, debug_writer=None, fused_warp=False,
+                 roi=False, threshold_engine='reference', prefilter='bilateral', track=False,
+                 overlay='warp', work_scale=1, warp_maps=False):
+        self.input_video = input_video
+        self.output_video = output_video
+        self.tracker = tracker
+        self.debug_writer = debug_writer
+        if fused_warp and (roi or warp_maps):
+            raise Exception("Fused warp thresholds the whole frame with its own remap, "
+                            "it does not combine with roi or warp maps.")
+        self.fused_warp = fused_warp
+        self.roi = roi
+        self.threshold_engine = threshold_engine
+        self.prefilter = prefilter
+        self.track = track
+        if overlay not in VideoProcessor.OVERLAYS:
+            raise Exception("Invalid overlay {}.".format(overlay))
+        self.overlay = overlay
+        if work_scale < 1:
+            raise Exception("Invalid work scale {}.".format(work_scale))
+        self.work_scale = work_scale
+        self.warp_maps = warp_maps
 
-    @staticmethod
-    def write_debug_images(image, undist, binary, perspective, lanes, final):
-        ''' Writes intermediate images to debug_dir '''
-        filename = str(VideoProcessor.debug_frame_number) + '.png'
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'original', filename), image)
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'undist', filename), undist)
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'binary', filename), binary)
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'perspective', filename), perspective)
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'lanes', filename), lanes)
-        cv2.imwrite(os.path.join(VideoProcessor.debug_dir, 'final', filename), final)
+    def process_image(self, image):
+        ''' process each RGB frame image '''
+        timer = self.tracker.timer
+        timer.start_frame()
+        with timer.stage('color convert'):
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        image = self.process_bgr(image)
+        with timer.stage('color convert'):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        timer.end_frame()
+        return image
 
-    @staticmethod
-    def process_image(image):
-        ''' process each frame image '''
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-        image_undist = VideoProcessor.cam_cal.undistort(image)
-        bin_img = BinaryImage(image_undist, kernel=5, grad_thresh=(20, 100),
-                              sat_thresh=(120, 255), light_thresh=(45, 255),
-                              mag_thresh=(30, 100), dir_thresh=(0.7, 1.3))
-        image_binary = bin_img.get()
-        pers_img = PerspectiveTransform(image_binary)
-        image_perspective = pers_img.get()
+    def process_bgr(self, image):
+        ''' process each BGR frame image '''
+        timer = self.tracker.timer
+        timer.start_frame()
+        finder, image_undist, image_binary, image_perspective = self.find_bgr(image)
+        output = self.draw_lanes(finder, image, image_undist, image_binary, image_perspective)
+        timer.end_frame()
+        return output
+
+    def find_bgr(self, image, undistort=True):
+        ''' finds the lanes of a BGR frame, only keyframes run the full detection when the
+            tracker has a keyframe scheduler. Returns the LaneFinder together with the
+            undistorted, binary and bird-eyes images, the undistorted image of a frame searched
+            at subsampled resolution is only made when undistort is set. '''
+        scheduler = self.tracker.scheduler
+        if scheduler is not None and not scheduler.is_keyframe():
+            found = self.update_bgr(image, undistort)
+            if found is not None:
+                return found
+            scheduler.update_failed()
+        found = self.prepare_bgr(image, undistort)
+        self.track_lanes(found[0])
+        if scheduler is not None:
+            scheduler.keyframe_done(self.tracker, found[0].height)
+        return found
+
+    def update_bgr(self, image, undistort=True):
+        ''' updates the lanes of a frame between keyframes by tracking them on the bird-eyes
+            view of a binary image thresholded at subsampled resolution, or holds the averaged
+            fits without subsampling. Returns the LaneFinder with the undistorted, binary and
+            bird-eyes images like prepare_bgr, or None when tracking fails its sanity checks. '''
+        tracker = self.tracker
+        timer = tracker.timer
+        scale = tracker.scheduler.subsample
+        if scale:
+            finder, image_undist, image_binary, image_perspective = self.prepare_scaled_bgr(
+                image, scale, tracker.update_buffers, undistort)
+            with timer.stage('lane search'):
+                if not finder.track_lanes():
+                    return None
+        else:
+            image_undist = self.undistort_bgr(image, undistort)
+            image_perspective = image_binary = np.zeros(image.shape[:2], np.uint8)
+            with timer.stage('lane search'):
+                finder = LaneFinder(image_perspective, tracker=tracker)
+                finder.hold_lanes()
+        tracker.search_paths[finder.search_path] += 1
+        tracker.add_record(finder)
+        tracker.scheduler.update_done(tracker, finder.height)
+        return finder, image_undist, image_binary, image_perspective
+
+    def undistort_bgr(self, image, undistort=True):
+        ''' returns the image lanes are drawn on, the raw frame with fused_warp, the
+            undistorted frame or None when undistort is not set '''
+        if self.fused_warp:
+            return image
+        if not undistort:
+            return None
+        with self.tracker.timer.stage('undistort'):
+            return self.tracker.cam_cal.undistort(image)
+
+    def prepare_scaled_bgr(self, image, scale, buffers, undistort=True):
+        ''' undistorts and subsamples a BGR frame by an integer scale in one remap, then
+            thresholds and warps it at that size into buffers. Returns the LaneFinder of the
+            subsampled bird-eyes image, searching in full resolution coordinates, together with
+            the images like prepare_bgr, the full resolution undistorted image is only made when
+            undistort is set. '''
+        tracker = self.tracker
+        timer = tracker.timer
+        img_size = (image.shape[1], image.shape[0])
+        small_size = (img_size[0] // scale, img_size[1] // scale)
+        image_undist = self.undistort_bgr(image, undistort)
+        with timer.stage('undistort'):
+            subsample = PerspectiveTransform.get_subsample_matrix(scale)
+            map1, map2 = tracker.cam_cal.get_warp_maps(img_size, subsample, small_size)
+            image_small = cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=get_buffer(
+                buffers, 'undist', (small_size[1], small_size[0], 3), image.dtype))
+        with timer.stage('threshold'):
+            roi = None
+            if self.roi:
+                x0, y0, x1, y1 = PerspectiveTransform(image).get_roi()
+                roi = (x0 // scale, y0 // scale, -(-x1 // scale), -(-y1 // scale))
+            # the gradient kernel spans about as much of the road as 5 pixels in full resolution
+            bin_img = BinaryImage(image_small, kernel=max((5 // scale) | 1, 3),
+                                  grad_thresh=(20, 100), sat_thresh=(120, 255),
+                                  light_thresh=(45, 255), mag_thresh=(30, 100),
+                                  dir_thresh=(0.7, 1.3), roi=roi, engine=self.threshold_engine,
+                                  buffers=buffers, prefilter=self.prefilter)
+            image_binary = bin_img.get(get_buffer(buffers, 'binary', bin_img.shape, np.uint8))
+        with timer.stage('warp'):
+            M = PerspectiveTransform.get_geometry(img_size, scale)['M']
+            image_perspective = cv2.warpPerspective(
+                image_binary, M, small_size, dst=get_buffer(
+                    buffers, 'perspective', image_binary.shape, image_binary.dtype),
+                flags=cv2.INTER_LINEAR)
+        with timer.stage('lane search'):
+            finder = LaneFinder(image_perspective, tracker=tracker, scale=scale)
+        return finder, image_undist, image_binary, image_perspective
+
+    def prepare_bgr(self, image, undistort=True):
+        ''' undistorts, thresholds and warps a BGR frame, returns the LaneFinder of its
+            bird-eyes binary image together with the undistorted, binary and bird-eyes images.
+            Only a frame processed at a work_scale above 1 may skip the full resolution
+            undistorted image when undistort is not set. '''
+        tracker = self.tracker
+        timer = tracker.timer
+        if self.work_scale != 1:
+            return self.prepare_scaled_bgr(image, self.work_scale, tracker.buffers, undistort)
+        if self.fused_warp:
+            # threshold the raw frame, then undistort and warp the binary image in one remap
+            image_undist = image
+            with timer.stage('threshold'):
+                bin_img = BinaryImage(image, kernel=5, grad_thresh=(20, 100),
+                                      sat_thresh=(120, 255), light_thresh=(45, 255),
+                                      mag_thresh=(30, 100), dir_thresh=(0.7, 1.3),
+                                      engine=self.threshold_engine, buffers=tracker.buffers,
+                                      prefilter=self.prefilter)
+                image_binary = bin_img.get(tracker.get_buffer('binary', bin_img.shape, np.uint8))
+            with timer.stage('warp'):
+                image_perspective = PerspectiveTransform(image_binary, tracker.cam_cal).get(
+                    tracker.get_buffer('perspective', image_binary.shape, image_binary.dtype))
+        else:
+            with timer.stage('undistort'):
+                image_undist = tracker.cam_cal.undistort(image)
+            with timer.stage('threshold'):
+                roi = PerspectiveTransform(image_undist) if self.roi else None
+                bin_img = BinaryImage(image_undist, kernel=5, grad_thresh=(20, 100),
+                                      sat_thresh=(120, 255), light_thresh=(45, 255),
+                                      mag_thresh=(30, 100), dir_thresh=(0.7, 1.3), roi=roi,
+                                      engine=self.threshold_engine, buffers=tracker.buffers,
+                                      prefilter=self.prefilter)
+                image_binary = bin_img.get(tracker.get_buffer('binary', bin_img.shape, np.uint8))
+            with timer.stage('warp'):
+                pers_img = PerspectiveTransform(image_binary, use_maps=self.warp_maps)
+                image_perspective = pers_img.get(
+                    tracker.get_buffer('perspective', image_binary.shape, image_binary.dtype))
         #image_perspective = cv2.cvtColor(image_perspective, cv2.COLOR_BGR2GRAY)
-        finder = LaneFinder(image_perspective, cache=True)
-        finder.slide_window(n_windows=9)
-        image_perspective_overlay = finder.visualize(draw_lane_pixels=False, draw_on_image=False,
-                                                     draw_windows=False)
-        pers_img = PerspectiveTransform(image_perspective_overlay)
-        image_overlay = pers_img.get_inverse()
-        undist_overlay = cv2.addWeighted(image_undist, 1, image_overlay, 0.3, 0)
-        undist_overlay = finder.draw_info(undist_overlay)
-        if VideoProcessor.debug_dir is not None:
-            if VideoProcessor.debug_frame_number % VideoProcessor.debug_frame_bypass == 0:
-                image_lanes = finder.visualize()
-                VideoProcessor.write_debug_images(image, image_undist, image_binary, image_perspective,
-                                                  image_lanes, undist_overlay)
-            VideoProcessor.debug_frame_number += 1
-        return cv2.cvtColor(undist_overlay, cv2.COLOR_BGR2RGB)
+        with timer.stage('lane search'):
+            finder = LaneFinder(image_perspective, tracker=tracker)
+        return finder, image_undist, image_binary, image_perspective
+
+    def track_lanes(self, finder):
+        ''' runs the sequential lane search of finder, updating the tracker '''
+        tracker = self.tracker
+        with tracker.timer.stage('lane search'):
+            search_path = finder.find_lanes(n_windows=9, track=self.track)
+            tracker.search_paths[search_path] += 1
+            tracker.add_record(finder)
+        return search_path
+
+    def track_and_draw(self, finder, image, image_undist, image_binary, image_perspective):
+        ''' runs the sequential lane search of finder and draws the lane on image_undist '''
+        self.track_lanes(finder)
+        return self.draw_lanes(finder, image, image_undist, image_binary, image_perspective)
+
+    def draw_lanes(self, finder, image, image_undist, image_binary, image_perspective):
+        ''' draws the averaged lane of finder on image_undist, the other images go to the
+            debug writer '''
+        tracker = self.tracker
+        timer = tracker.timer
+        if self.overlay == 'project':
+            with timer.stage('overlay render'):
+                pers_img = PerspectiveTransform(image_undist,
+                                                tracker.cam_cal if self.fused_warp else None)
+                points = pers_img.get_inverse_points(finder.lane_polygon())
+            with timer.stage('blend'):
+                undist_overlay = image_undist
+                if self.fused_warp or self.debug_writer is not None:
+                    # the input frame or a debug stage, blended into a copy
+                    undist_overlay = image_undist.copy()
+                blend_polygon(undist_overlay, points)
+        else:
+            with timer.stage('overlay render'):
+                image_perspective_overlay = finder.visualize(draw_lane_pixels=False,
+                                                             draw_on_image=False,
+                                                             draw_windows=False)
+            with timer.stage('inverse warp'):
+                if self.fused_warp:
+                    pers_img = PerspectiveTransform(image_perspective_overlay, tracker.cam_cal)
+                else:
+                    pers_img = PerspectiveTransform(image_perspective_overlay,
+                                                    use_maps=self.warp_maps)
+                image_overlay = pers_img.get_inverse(
+                    tracker.get_buffer('overlay', image_perspective_overlay.shape,
+                                       image_perspective_overlay.dtype))
+            with timer.stage('blend'):
+                undist_overlay = cv2.addWeighted(image_undist, 1, image_overlay, 0.3, 0)
+        with timer.stage('text'):
+            undist_overlay = finder.draw_info(undist_overlay)
+        debug_writer = self.debug_writer
+        if debug_writer is not None:
+            with timer.stage('debug'):
+                if debug_writer.wants(tracker.debug_frame_number):
+                    images = {'original': image, 'undist': image_undist, 'binary': image_binary,
+                              'perspective': image_perspective, 'final': undist_overlay}
+                    if debug_writer.wants(tracker.debug_frame_number, 'lanes'):
+                        images['lanes'] = finder.visualize()
+                    debug_writer.submit(tracker.debug_frame_number, images)
+            tracker.debug_frame_number += 1
+        return undist_overlay
+
+    def process_batch(self, frames, output=None):
+        ''' process an (N, H, W, 3) stack of BGR frames, color conversion, thresholds and the
+            lane start histograms run over the whole stack before lanes are tracked frame by
+            frame, thresholds always use the fast engine votes. Stage times of the whole stack
+            are shared evenly by its frames. '''
+        tracker = self.tracker
+        timer = tracker.timer
+        if tracker.scheduler is not None:
+            raise Exception("Keyframe scheduling processes one frame at a time.")
+        if self.work_scale != 1:
+            raise Exception("Batches are processed at full resolution only.")
+        batch = BatchProcessor(kernel=5, grad_thresh=(20, 100), sat_thresh=(120, 255),
+                               light_thresh=(45, 255), mag_thresh=(30, 100),
+                               dir_thresh=(0.7, 1.3), prefilter=self.prefilter,
+                               buffers=tracker.buffers)
+        if output is None:
+            output = np.empty_like(frames)
+        batch_times = []
+        start = time.perf_counter()
+        if self.fused_warp:
+            # threshold the raw frames, then undistort and warp the binary images in one remap
+            images_undist = frames
+            images_binary = batch.threshold(frames, tracker.get_buffer(
+                'batch_binary', frames.shape[:3], np.uint8))
+            batch_times.append(('threshold', time.perf_counter()))
+            images_perspective = batch.warp(images_binary, tracker.get_buffer(
+                'batch_perspective', images_binary.shape, images_binary.dtype), tracker.cam_cal)
+            batch_times.append(('warp', time.perf_counter()))
+        else:
+            images_undist = tracker.get_buffer('batch_undist', frames.shape, frames.dtype)
+            for index in range(frames.shape[0]):
+                tracker.cam_cal.undistort(frames[index], images_undist[index])
+            batch_times.append(('undistort', time.perf_counter()))
+            if self.roi:
+                batch.roi = PerspectiveTransform(images_undist[0]).get_roi()
+            images_binary = batch.threshold(images_undist, tracker.get_buffer(
+                'batch_binary', frames.shape[:3], np.uint8))
+            batch_times.append(('threshold', time.perf_counter()))
+            images_perspective = batch.warp(images_binary, tracker.get_buffer(
+                'batch_perspective', images_binary.shape, images_binary.dtype),
+                use_maps=self.warp_maps)
+            batch_times.append(('warp', time.perf_counter()))
+        histograms, left_starts, right_starts = batch.find_lane_starts(images_perspective)
+        batch_times.append(('lane search', time.perf_counter()))
+        shares = []
+        for name, end in batch_times:
+            shares.append((name, (end - start) / frames.shape[0]))
+            start = end
+        for index in range(frames.shape[0]):
+            timer.start_frame()
+            for name, seconds in shares:
+                timer.add(name, seconds, outside=True)
+            finder = LaneFinder(images_perspective[index], tracker=tracker,
+                                histogram=histograms[index],
+                                lane_starts=(left_starts[index], right_starts[index]))
+            output[index] = self.track_and_draw(finder, frames[index], images_undist[index],
+                                                images_binary[index], images_perspective[index])
+            timer.end_frame()
+        return output
+
+    @staticmethod
+    def load_calibration(camera_input=None, camera_cal_directory='camera_cal', cache_dir=None):
+        ''' loads camera_input when given, otherwise calibrates from camera_cal_directory '''
+        if camera_input is not None:
+            cam_cal = CameraCalibration()
+            cam_cal.load(camera_input)
+            return cam_cal
+        return VideoProcessor.calibrate_camera(camera_cal_directory, cache_dir)
 
     @staticmethod
-    def calibrate_camera(camera_cal_directory):
-        ''' calibrating camera '''
-        filenames = os.listdir(camera_cal_directory)
+    def calibrate_camera(camera_cal_directory, cache_dir=None, scale=0.5):
+        ''' calibrating camera, reusing a cached result when the image set, the calibration
+            parameters and CALIBRATION_VERSION are unchanged '''
+        digest = hashlib.sha1()
+        digest.update(repr((CALIBRATION_VERSION, CHESSBOARD_SIZE, scale)).encode('utf-8'))
         images = []
-        for filename in filenames:
-            if filename.endswith('.jpg') or filename.endswith('.png'):
-                img = cv2.imread(os.path.join(camera_cal_directory, filename))
-                images.append(img)
+        for filename in image_filenames(camera_cal_directory):
+            with open(os.path.join(camera_cal_directory, filename), 'rb') as input_file:
+                data = input_file.read()
+            digest.update(filename.encode('utf-8'))
+            digest.update(data)
+            images.append(data)
         cam_cal = CameraCalibration()
-        cam_cal.compute(images)
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, digest.hexdigest() + '.p')
+            if os.path.exists(cache_file):
+                cam_cal.load(cache_file)
+                return cam_cal
+        images = [cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) for data in images]
+        cam_cal.compute(images, scale=scale)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cam_cal.save(cache_file)
         return cam_cal
 
-    @staticmethod
-    def process():
-        ''' process input video '''
+    def process(self, read_queue_size=8, write_queue_size=8, codec='libx264', batch_size=1):
+        ''' process input video, decoding and encoding overlap processing in their own threads,
+            frames are processed batch_size at a time when it is more than one and encoded
+            with the ffmpeg codec '''
+        process_frame = self.process_batch if batch_size > 1 else self.process_bgr
+        pipeline = FramePipeline(self.input_video, self.output_video, process_frame,
+                                 read_queue_size, write_queue_size, codec, batch_size)
+        utilization = pipeline.run()
+        print('Processed {} frames, stage utilization: read {:.0%}, process {:.0%}, '
+              'write {:.0%}'.format(pipeline.frames, utilization['read'],
+                                    utilization['process'], utilization['write']))
+        self.close_debug_writer()
+        self.print_search_paths()
+
+    def print_search_paths(self):
+        ''' reports how the lanes of the processed frames were found '''
+        tracker = self.tracker
+        print('Lane search: {} tracked frames, {} sliding window frames'.format(
+            tracker.search_paths['track'], tracker.search_paths['window']))
+        if tracker.scheduler is not None:
+            print('{}, {} frames held'.format(tracker.scheduler.report(),
+                                             tracker.search_paths['hold']))
+
+    def process_metrics(self, metrics_file, chunk_size=1000, read_queue_size=8):
+        ''' finds the lanes of the input video without drawing or encoding anything, the lane
+            record of every frame goes to metrics_file in chunks of chunk_size frames '''
+        tracker = self.tracker
+        timer = tracker.timer
+        metrics = MetricsWriter(metrics_file, chunk_size)
+        pipeline = None
+
+        def measure_bgr(image):
+            timer.start_frame()
+            finder = self.find_bgr(image, undistort=False)[0]
+            with timer.stage('metrics'):
+                metrics.add(lane_record(finder, metrics.count, metrics.count / pipeline.fps))
+            timer.end_frame()
+
+        pipeline = FramePipeline(self.input_video, None, measure_bgr, read_queue_size)
+        try:
+            utilization = pipeline.run()
+        finally:
+            metrics.close()
+        print('Measured {} frames into {} chunks, stage utilization: read {:.0%}, '
+              'process {:.0%}'.format(metrics.count, metrics.chunks, utilization['read'],
+                                      utilization['process']))
+        self.print_search_paths()
+
+    def close_debug_writer(self):
+        ''' flushes debug frames still queued and reports the dropped ones '''
+        if self.debug_writer is not None:
+            self.debug_writer.close()
+            print('Debug frames: {} written, {} dropped'.format(self.debug_writer.written,
+                                                                self.debug_writer.dropped))
+
+    def copy(self, output_video=None, tracker=None):
+        ''' returns a processor with the same options and a fresh tracker on the same camera '''
+        if tracker is None:
+            scheduler = self.tracker.scheduler
+            tracker = LaneTracker(self.tracker.cam_cal, self.tracker.left_line.average_count,
+                                  self.tracker.records is not None, self.tracker.timer.enabled,
+                                  scheduler.copy() if scheduler is not None else None)
+        return VideoProcessor(self.input_video, output_video, tracker, self.debug_writer,
+                              fused_warp=self.fused_warp, roi=self.roi,
+                              threshold_engine=self.threshold_engine, prefilter=self.prefilter,
+                              track=self.track, overlay=self.overlay,
+                              work_scale=self.work_scale, warp_maps=self.warp_maps)
+
+    def process_segment(self, start_frame, end_frame, warmup_frames=0, codec='libx264'):
+        ''' processes frames [start_frame, end_frame) after running up to warmup_frames earlier
+            frames through the tracker so its line history is warm, writes them to output_video
+            in the ffmpeg codec when set and returns the tracker '''
         from moviepy.editor import VideoFileClip
+        from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+        clip = VideoFileClip(self.input_video, audio=False)
+        end_frame = min(end_frame, int(round(clip.duration * clip.fps)))
+        debug_writer, self.debug_writer = self.debug_writer, None
+        for index in range(max(start_frame - warmup_frames, 0), start_frame):
+            self.process_image(clip.get_frame(index / clip.fps))
+        self.debug_writer = debug_writer
+        self.tracker.debug_frame_number = start_frame
+        self.tracker.search_paths = dict.fromkeys(self.tracker.search_paths, 0)
+        if self.tracker.records is not None:
+            self.tracker.records = []
+        self.tracker.timer.reset(start_frame)
+        if self.tracker.scheduler is not None:
+            self.tracker.scheduler.reset()
+        writer = None
+        if self.output_video is not None:
+            writer = FFMPEG_VideoWriter(self.output_video, clip.size, clip.fps, codec=codec)
+        for index in range(start_frame, end_frame):
+            frame = self.process_image(clip.get_frame(index / clip.fps))
+            if writer is not None:
+                writer.write_frame(frame)
+        if writer is not None:
+            writer.close()
+        clip.close()
+        self.close_debug_writer()
+        return self.tracker
 
-        clip = VideoFileClip(VideoProcessor.input_video)
-        new_clip = clip.fl_image(VideoProcessor.process_image)
-        new_clip.write_videofile(VideoProcessor.output_video, audio=False)
+    def process_segmented(self, jobs, warmup_frames=10, codec='libx264'):
+        ''' splits the input video in jobs time segments, processes them in a process pool and
+            stitches the outputs, encoded in the ffmpeg codec, into output_video, returns the
+            trackers of all segments
+
+        Each segment pre-rolls warmup_frames frames. Without look-ahead tracking the output
+        only depends on the last average_count + 2 frames, so with the default pre-roll the
+        segments reproduce a serial run; with tracking frames within warmup_frames after a
+        segment boundary may take a different search path and differ slightly.
+        '''
+        from moviepy.editor import VideoFileClip
+        from moviepy.config import get_setting
+
+        clip = VideoFileClip(self.input_video, audio=False)
+        n_frames = int(round(clip.duration * clip.fps))
+        clip.close()
+        # no empty segments, ffmpeg can't stitch a segment without frames
+        jobs = max(min(jobs, n_frames), 1)
+        bounds = [n_frames * job // jobs for job in range(jobs + 1)]
+        segment_dir = None
+        processors = []
+        if self.output_video is not None:
+            segment_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.output_video)))
+        try:
+            for job in range(jobs):
+                output_video = None
+                if segment_dir is not None:
+                    output_video = os.path.join(segment_dir, '{:04d}.mp4'.format(job))
+                processors.append(self.copy(output_video))
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(processor.process_segment, bounds[job],
+                                           bounds[job + 1], warmup_frames, codec)
+                           for job, processor in enumerate(processors)]
+                trackers = [future.result() for future in futures]
+            if segment_dir is not None:
+                list_file = os.path.join(segment_dir, 'segments.txt')
+                with open(list_file, 'w') as output:
+                    for processor in processors:
+                        output.write("file '{}'\n".format(processor.output_video))
+                subprocess.check_call([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+                                       '-f', 'concat', '-safe', '0', '-i', list_file,
+                                       '-c', 'copy', self.output_video])
+        finally:
+            if segment_dir is not None:
+                shutil.rmtree(segment_dir, ignore_errors=True)
+        for key in self.tracker.search_paths:
+            self.tracker.search_paths[key] = sum(tracker.search_paths[key] for tracker in trackers)
+        for tracker in trackers:
+            self.tracker.timer.extend(tracker.timer)
+            if self.tracker.scheduler is not None:
+                self.tracker.scheduler.extend(tracker.scheduler)
+        self.print_search_paths()
+        return trackers
+
+    @staticmethod
+    def process_concurrently(processors, max_workers=None):
+        ''' processes several videos in a thread pool, each with its own LaneTracker '''
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(processor.process) for processor in processors]:
+                future.result()
 